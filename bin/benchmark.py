@@ -0,0 +1,226 @@
+#!python
+"""
+benchmark.py
+by Fred Ross, <madhadron@gmail.com>
+
+Time the stages of an analysis on synthetic data (see
+rnaseq/synthetic.py) at several numbers of transcripts, and write the
+timings as JSON.  For each scale, a synthetic experiment is written
+to a temporary directory and loaded into a fresh database, then each
+of load_sam, find_subproblems, get_sample, build_model and sampling
+is timed in turn.  All times are in seconds.
+
+Model building and sampling are timed on the largest subproblem and
+on a single transcript subproblem, since those are the two extremes
+every run has to deal with.  Sampling is reported per iteration.  The
+'map' method is timed finding the posterior mode instead.
+"""
+
+import getopt
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import sqlite3
+import numpy as np
+from rnaseq import *
+from rnaseq.load import create_indexes
+from rnaseq.model import get_sample
+from rnaseq.synthetic import write_dataset
+import rnaseq.instrument as instrument
+
+usage = """benchmark.py [-vhk] [-s scales] [-n n_reads] [-g n] [-i iterations] [-m methods] [-r seed] [--profile file] output.json
+
+-v             Run verbosely
+-h             Print this message and exit
+-k             Keep the synthetic data and databases instead of deleting them
+-s scales      Comma separated numbers of transcripts to run at
+               (default 100,1000,10000)
+-n n_reads     Number of reads in each sample (default 1000000)
+-g n           Number of samples in each group (default 3)
+-i iterations  Number of iterations to time sampling over (default 200)
+-m methods     Comma separated methods to build and sample with
+               (default pymc,vector,native,map)
+-r seed        Seed for the synthetic data (default 0)
+--profile file Write timings and counts of the whole run to 'file' as JSON
+output.json    File to write the timings to
+"""
+
+class Usage(Exception):
+    def __init__(self,  msg):
+        self.msg = msg
+
+class State(object):
+    def __init__(self):
+        self.verbose = False
+        self.keep = False
+        self.scales = [100, 1000, 10000]
+        self.n_reads = 1000000
+        self.n_samples = 3
+        self.iterations = 200
+        self.methods = ['pymc', 'vector', 'native', 'map']
+        self.seed = 0
+        self.profile = None
+
+state = State()
+
+def vmsg(msg):
+    if state.verbose:
+        print >>sys.stderr, msg
+
+def timed(f, *args, **kwargs):
+    """Call *f* and return a pair (seconds taken, result)."""
+    start = time.time()
+    result = f(*args, **kwargs)
+    return (time.time() - start, result)
+
+def time_sampling(db, transcripts, method):
+    """Time building and sampling a model of *transcripts* by *method*.
+
+    Returns a dictionary with the seconds taken by build_model and by
+    each iteration of sampling (or, for 'map', to find the mode).
+    """
+    build_method = 'native' if method == 'map' else method
+    (build, M) = timed(build_model, db, 1, 2, transcripts,
+                       method=build_method)
+    if method == 'map':
+        (seconds, passes) = timed(M.maximize)
+        return {'build_model': build, 'maximize': seconds, 'passes': passes}
+    (seconds, ignore) = timed(M.sample, state.iterations)
+    return {'build_model': build, 'iteration': seconds / state.iterations}
+
+def run_scale(directory, n_transcripts):
+    """Run every benchmark on *n_transcripts* transcripts in *directory*."""
+    r = {'n_transcripts': n_transcripts}
+    (r['generate'], (group1_files, group2_files, parameters)) = \
+        timed(write_dataset, directory, n_transcripts,
+              n_samples=(state.n_samples, state.n_samples),
+              n_reads=state.n_reads, seed=state.seed)
+    vmsg("Wrote synthetic data for %d transcripts in %s" % (n_transcripts, directory))
+
+    db = instrument.connect(os.path.join(directory, "benchmark.db"))
+    initialize_database(db)
+    group1 = insert_sample_group(db, 'Group 1', False)
+    group2 = insert_sample_group(db, 'Group 2', False)
+    r['load_sam'] = []
+    for files,group in [(group1_files,group1), (group2_files,group2)]:
+        for f in files:
+            (seconds, sample) = timed(load_sam, db, f, group, index=False)
+            r['load_sam'].append(seconds)
+    (r['create_indexes'], ignore) = timed(create_indexes, db)
+    vmsg("Loaded %d files" % len(r['load_sam']))
+
+    (r['find_subproblems'], subproblems) = timed(find_subproblems, db)
+    r['n_subproblems'] = len(subproblems)
+    r['largest_subproblem'] = len(subproblems[0])
+    largest = subproblems[0]
+    singleton = subproblems[-1]
+
+    samples = [s for (s,) in db.execute("""select id from samples""")]
+    r['get_sample'] = {}
+    (seconds, ignore) = timed(get_sample, db, samples[0], largest)
+    r['get_sample']['largest'] = seconds
+    (seconds, ignore) = timed(get_sample, db, samples[0], singleton)
+    r['get_sample']['singleton'] = seconds
+    (seconds, ignore) = timed(get_sample, db, samples[0],
+                              [t for sp in subproblems for t in sp])
+    r['get_sample']['all'] = seconds
+    vmsg("Timed get_sample")
+
+    r['methods'] = {}
+    for method in state.methods:
+        r['methods'][method] = {'largest': time_sampling(db, largest, method),
+                                'singleton': time_sampling(db, singleton, method)}
+        vmsg("Timed method %s" % method)
+    db.close()
+    return r
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        try:
+            opts, args = getopt.getopt(argv, "hvks:n:g:i:m:r:",
+                                       ["help","verbose","profile="])
+        except getopt.error, message:
+            raise Usage(message)
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                print __doc__
+                print usage
+                sys.exit(0)
+            elif o in ("-v", "--verbose"):
+                state.verbose = True
+                print "Running verbosely."
+            elif o in ("-k", ):
+                state.keep = True
+            elif o in ("--profile", ):
+                state.profile = a
+            elif o in ("-s", "-n", "-g", "-i", "-r"):
+                try:
+                    values = [int(x) for x in a.split(',')]
+                except ValueError, v:
+                    raise Usage("Option %s takes integers, found %s" % (o,a))
+                if o == "-s":
+                    state.scales = values
+                elif len(values) != 1:
+                    raise Usage("Option %s takes a single integer, found %s" % (o,a))
+                elif o == "-n":
+                    state.n_reads = values[0]
+                elif o == "-g":
+                    state.n_samples = values[0]
+                elif o == "-i":
+                    state.iterations = values[0]
+                else:
+                    state.seed = values[0]
+            elif o in ("-m", ):
+                methods = a.split(',')
+                for m in methods:
+                    if not(m in ('pymc', 'vector', 'native', 'map')):
+                        raise Usage("Methods must be pymc, vector, native or map, found %s" % m)
+                state.methods = methods
+            else:
+                raise Usage("Unhandled option: " + o)
+        if state.profile != None:
+            instrument.enable()
+        if len(args) != 1:
+            raise Usage("benchmark.py takes exactly one argument.")
+        output_filename = args[0]
+
+        results = {'platform': platform.platform(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'started': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   'n_reads': state.n_reads,
+                   'n_samples': state.n_samples,
+                   'iterations': state.iterations,
+                   'seed': state.seed,
+                   'scales': []}
+        for n in state.scales:
+            directory = tempfile.mkdtemp(prefix="rnaseq-benchmark-")
+            try:
+                results['scales'].append(run_scale(directory, n))
+            finally:
+                if state.keep:
+                    vmsg("Kept synthetic data in %s" % directory)
+                else:
+                    shutil.rmtree(directory)
+            # Write after every scale, so a long run that is stopped
+            # still leaves the scales it finished.
+            with open(output_filename, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            vmsg("Finished %d transcripts" % n)
+        if state.profile != None:
+            instrument.write_report(state.profile)
+
+        return 0
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, usage
+        return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
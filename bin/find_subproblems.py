@@ -11,6 +11,9 @@ This script uses a graph which is a union of all comparisons between
 sample groups.  Biologically, this is unlikely to make much difference
 since two transcripts which are connected in one pair of groups are
 likely to be connected in most groups.
+
+load_sam keeps the subproblems up to date in the database as each
+sample is loaded, so this only reads them back.
 """
 
 import getopt
@@ -18,11 +21,14 @@ import os
 import sys
 import sqlite3
 import rnaseq.subproblems
+import rnaseq.instrument as instrument
 
-usage = """find_subproblems.py [-vh] db
+usage = """find_subproblems.py [-vh] [--profile file] db
 
 -v   Run verbosely
 -h   Print this message and exit
+--profile file
+     Write timings and counts of this run to 'file' as JSON
 db   Database file to find subproblems in
 """
 
@@ -33,6 +39,7 @@ class Usage(Exception):
 class State(object):
     def __init__(self):
         self.verbose = False
+        self.profile = None
 
 state = State()
 
@@ -45,7 +52,7 @@ def main(argv=None):
         argv = sys.argv[1:]
     try:
         try:
-            opts, args = getopt.getopt(argv, "hv", ["help"])
+            opts, args = getopt.getopt(argv, "hv", ["help","profile="])
         except getopt.error, message:
             raise Usage(message)
         for o, a in opts:
@@ -56,8 +63,12 @@ def main(argv=None):
             if o in ("-v", ):
                 state.verbose=True
                 print "Running verbosely."
+            elif o in ("--profile", ):
+                state.profile = a
             else:
                 raise Usage("Unhandled option: " + o)
+        if state.profile != None:
+            instrument.enable()
         if len(args) != 1:
             raise Usage("find_subproblems.py takes exactly one argument.")
 
@@ -65,11 +76,13 @@ def main(argv=None):
         if not(os.path.exists(db_filename)):
             raise Usage("Database file %s does not exist" % db_filename)
 
-        db = sqlite3.connect(db_filename)
-        for q in find_subproblems(db):
+        db = instrument.connect(db_filename)
+        for q in rnaseq.subproblems.find_subproblems(db):
             print ' '.join([str(x) for x in q])
 
         db.close()
+        if state.profile != None:
+            instrument.write_report(state.profile)
     
         return 0
     except Usage, err:
@@ -4,6 +4,16 @@ inference_subproblem.py
 by Fred Ross, <madhadron@gmail.com>
 
 Runs a one-way linear model on a given set of transcripts as loaded in a given database.  Writes the result as a pikle of a dictionary of parameters pointing to a dictionary of transcript keys pointing to NumPy arrays of the posteriors for those samples.
+
+With -f, runs many subproblems listed in a file, one after another in
+the same process, and writes all their posteriors into the one pickle.
+
+With -p, compares further pairs of groups besides group1 and group2.
+Each sample is read from the database once for all the pairs, and the
+pickle holds a list of (group1, group2, posteriors) tuples, one per
+pair, instead of a single tuple.  With -1 as well, all the groups are
+fit in a single model (see build_oneway_model) instead of one model
+per pair.
 """
 
 import getopt
@@ -12,15 +22,30 @@ import sys
 import sqlite3
 import pickle
 from rnaseq import *
+from rnaseq.subproblems import missing_transcripts, read_subproblems
+from rnaseq.posteriors import posteriors_of_traces
+import rnaseq.instrument as instrument
 
-usage = """inference_subproblem.py [-vh] [-n n_samples] pickle_file db group1 group2 transcripts ...
+usage = """inference_subproblem.py [-vh1] [-m method] [-n n_samples] [-f subproblems] [-p g1:g2 ...] [--profile file] [--cprofile file] pickle_file db group1 group2 [transcripts ...]
 
 -v             Run verbosely
 -h             Print this message and exit
 db             The SQLite3 database to read from.
 -n n_samples   Produce n_samples samples of the posterior.
+-m method      Build the model with 'pymc' (the default), 'vector' or
+               'native' (see build_model)
 group1,group2  Integers giving the group IDs to work on.
 transcripts    Integers giving the transcripts to do inference on.
+-f subproblems A file listing subproblems to do inference on, one per
+               line as space separated transcript IDs, as printed by
+               find_subproblems.py.
+-p g1:g2       Also compare groups g1 and g2.  May be given many times.
+-1             Fit all the groups in one model instead of one model
+               per pair.
+--profile file Write timings and counts of this run to 'file' as JSON
+--cprofile file
+               Run the largest subproblem under cProfile, and save the
+               statistics to 'file'
 """
 
 class Usage(Exception):
@@ -31,6 +56,12 @@ class State(object):
     def __init__(self):
         self.verbose = False
         self.n_samples = 500
+        self.method = 'pymc'
+        self.subproblems_file = None
+        self.pairs = []
+        self.oneway = False
+        self.profile = None
+        self.cprofile = None
 
 state = State()
 
@@ -43,7 +74,8 @@ def main(argv=None):
         argv = sys.argv[1:]
     try:
         try:
-            opts, args = getopt.getopt(argv, "hvn:", ["help","verbose"])
+            opts, args = getopt.getopt(argv, "hv1m:n:f:p:", ["help","verbose",
+                                                          "profile=","cprofile="])
         except getopt.error, message:
             raise Usage(message)
         for o, a in opts:
@@ -59,10 +91,32 @@ def main(argv=None):
                     state.n_samples = int(a)
                 except ValueError, v:
                     raise Usage("Number of samples must be an integer, found %s" % a)
+            elif o in ("-m", ):
+                if not(a in ('pymc', 'vector', 'native')):
+                    raise Usage("Method must be one of pymc, vector or native, found %s" % a)
+                state.method = a
+            elif o in ("-f", ):
+                if not(os.path.exists(a)):
+                    raise Usage("Subproblems file %s does not exist." % a)
+                state.subproblems_file = a
+            elif o in ("-p", ):
+                try:
+                    (g1,g2) = [int(x) for x in a.split(':')]
+                except ValueError, v:
+                    raise Usage("Pairs must be two integers separated by a colon, found %s" % a)
+                state.pairs.append((g1,g2))
+            elif o in ("-1", ):
+                state.oneway = True
+            elif o in ("--profile", ):
+                state.profile = a
+            elif o in ("--cprofile", ):
+                state.cprofile = a
             else:
                 raise Usage("Unhandled option: " + o)
-        if len(args) < 5:
-            raise Usage("simple_inference.py takes at least five arguments.")
+        if state.profile != None:
+            instrument.enable()
+        if len(args) < 5 and not(len(args) == 4 and state.subproblems_file):
+            raise Usage("inference.py takes at least five arguments, or four with -f.")
 
         pickle_filename = args[0]
         if os.path.exists(pickle_filename):
@@ -72,7 +126,7 @@ def main(argv=None):
         if not(os.path.exists(db_filename)):
             raise Usage("No such database %s" % db_filename)
         else:
-            db = sqlite3.connect(db_filename)
+            db = instrument.connect(db_filename)
 
         try:
             group1 = int(args[2])
@@ -90,36 +144,53 @@ def main(argv=None):
             raise Usage("All transcripts must be integers; found %s" %
                         ', '.join([str(t) for t in args[4:]]))
 
-        # Check that the given transcripts form a complete subproblem
-        if len(transcripts) > 1:
-            query = """select distinct a.transcript
-                       from (select * from multiplicity_entries
-                             where transcript not in %s) as a
-                       join (select * from multiplicity_entries 
-                             where transcript in %s) as b
-                       on a.multiplicity = b.multiplicity
-                    """ % (str(tuple(transcripts)), str(tuple(transcripts)))
-            missed_transcripts = [x for (x,) in db.execute(query)]
+        subproblems = []
+        if state.subproblems_file:
+            try:
+                subproblems.extend(read_subproblems(state.subproblems_file))
+            except ValueError, v:
+                raise Usage("All transcripts in %s must be integers." %
+                            state.subproblems_file)
+        if transcripts != []:
+            subproblems.append(transcripts)
+
+        # Check that the given transcripts form complete subproblems
+        for transcripts in subproblems:
+            missed_transcripts = missing_transcripts(db, transcripts)
             if missed_transcripts != []:
                 raise Usage("The given set of transcripts, %s, is incomplete.  The complete subproblem also contains %s" % (', '.join([str(t) for t in transcripts]),
                                                                                                                             ', '.join([str(t) for t in missed_transcripts])))
-                      
-
-        vmsg("Doing inference on transcripts %s" %
-             ', '.join([str(t) for t in transcripts]))
-        M = build_model(db, group1, group2, transcripts)
-        vmsg("Built model")
-        M.sample(state.n_samples*5 + 2000, burn=2000, thin=5)
-        vmsg("Sampled from model")
-
-        posteriors = {}
-        for i in transcripts:
-            posteriors[i] = {'mu': -1*M.trace('minusmu'+str(i))[:],
-                             'a': M.trace('a'+str(i))[:]}
+
+        pairs = [(group1,group2)] + [p for p in state.pairs
+                                     if p != (group1,group2)]
+        posteriors = dict([(p, {}) for p in pairs])
+        largest = max(subproblems, key=len) if subproblems != [] else None
+        for transcripts in subproblems:
+            vmsg("Doing inference on transcripts %s" %
+                 ', '.join([str(t) for t in transcripts]))
+            arguments = {'n_samples': state.n_samples,
+                         'method': state.method,
+                         'oneway': state.oneway}
+            if state.cprofile != None and transcripts is largest:
+                traces = instrument.profile_call(state.cprofile,
+                                                 sample_comparisons, db,
+                                                 pairs, transcripts,
+                                                 **arguments)
+            else:
+                traces = sample_comparisons(db, pairs, transcripts,
+                                            **arguments)
+            vmsg("Sampled from model")
+            for p in pairs:
+                posteriors[p].update(posteriors_of_traces(traces[p]))
         with open(pickle_filename, 'w') as pf:
-            pickle.dump((group1,group2,posteriors), pf)
+            if len(pairs) == 1:
+                pickle.dump((group1,group2,posteriors[(group1,group2)]), pf)
+            else:
+                pickle.dump([(g1,g2,posteriors[(g1,g2)]) for (g1,g2) in pairs], pf)
 
         vmsg("Wrote pickle file in %s" % pickle_filename)
+        if state.profile != None:
+            instrument.write_report(state.profile)
 
         return 0
     except Usage, err:
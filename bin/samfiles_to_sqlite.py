@@ -15,15 +15,30 @@ import sys
 import pysam
 import sqlite3
 from rnaseq.load import *
+import rnaseq.instrument as instrument
 
-usage = """samfiles_to_sqlite.py [-vh] [-l readlen] (-c|-x) [-g group] db samfiles ...
+usage = """samfiles_to_sqlite.py [-vh] [-l readlen] [-j n] [-s store] [-G grouping] (-c|-x) [-g group] [--profile file] db samfiles ...
 
 -v           Run verbosely
 -h           Print this message and exit
 -l readlen   Reads have length 'readlen' in SAM/BAM files
+-j n         Parse up to n SAM/BAM files at once in parallel processes,
+             or a single indexed BAM file n references at a time
+-s store     When creating db, keep its leftsites in a columnar sample
+             store in the directory 'store' instead of in SQLite
+-G grouping  How to find all the alignments of each read: 'name' for
+             files grouped by read name, as bowtie writes them, 'nh'
+             for files in any order with NH tags, such as coordinate
+             sorted BAM files, or 'hash' for files in any order without
+             them.  'nh' and 'hash' spill to $TMPDIR when a file has
+             too many multireads to hold in memory.  The default,
+             'auto', uses 'nh' for files whose header says they are
+             sorted by coordinate and 'name' otherwise.
 -c|-x        -c makes this group a control, -x makes it an experimental sample
 -g group     Insert the samfiles into the database with group ID 'group'.  If
              omitted, just uses the next free value in the database.
+--profile file
+             Write timings and counts of this run to 'file' as JSON
 db           The SQLite3 database to write to.
 samfiles     A list of SAM/BAM files, each containing the aligned reads
              from one biological sample.
@@ -40,6 +55,10 @@ class State(object):
         self.is_control = None
         self.group_id = None
         self.group_label = ""
+        self.workers = 1
+        self.store_path = None
+        self.profile = None
+        self.grouping = 'auto'
 
 state = State()
 
@@ -52,11 +71,12 @@ def main(argv=None):
         argv = sys.argv[1:]
     try:
         try:
-            opts, args = getopt.getopt(argv, "hvl:L:cxg:", 
+            opts, args = getopt.getopt(argv, "hvl:L:cxg:j:s:G:", 
                                        ["help","read-length",
                                         "group-label","control",
                                         "experimental",
-                                        "group-id"])
+                                        "group-id","jobs=","store=","grouping=",
+                                        "profile="])
         except getopt.error, message:
             raise Usage(message)
         for o, a in opts:
@@ -86,8 +106,24 @@ def main(argv=None):
                     raise Usage("Group ID must be an integer, found %s" % a)
             elif o in ("-L", "--group-label"):
                 state.group_label = a
+            elif o in ("-j", "--jobs"):
+                try:
+                    state.workers = int(a)
+                except ValueError, v:
+                    raise Usage("Number of jobs must be an integer, found %s" % a)
+            elif o in ("-s", "--store"):
+                state.store_path = a
+            elif o in ("-G", "--grouping"):
+                if not(a in GROUPINGS):
+                    raise Usage("Grouping must be one of %s, found %s" % \
+                                    (', '.join(GROUPINGS), a))
+                state.grouping = a
+            elif o in ("--profile", ):
+                state.profile = a
             else:
                 raise Usage("Unhandled option: " + o)
+        if state.profile != None:
+            instrument.enable()
         if len(args) < 2:
             raise Usage("samfiles_to_sqlite.py takes at least two arguments.")
         if state.is_control == None:
@@ -100,17 +136,22 @@ def main(argv=None):
                 raise Usage("Input file %s does not exist." % f)
 
         db_exists = os.path.exists(db_filename)
-        db = sqlite3.connect(db_filename)
+        db = instrument.connect(db_filename)
         if not(db_exists):
-            initialize_database(db)
+            initialize_database(db, state.store_path)
+        elif state.store_path != None:
+            raise Usage("Can only give a sample store when creating a database.")
 
         control_sample_group = insert_sample_group(db, state.group_label, 
                                                    state.is_control, 
                                                    state.group_id)
 
-        for f in samfiles:
-            load_sam(db, f, control_sample_group)
+        load_sams(db, samfiles, control_sample_group, workers=state.workers,
+                  grouping=state.grouping)
 
+        if state.profile != None:
+            instrument.write_report(state.profile,
+                                    database_bytes=os.path.getsize(db_filename))
         return 0
     except Usage, err:
         print >>sys.stderr, err.msg
@@ -7,6 +7,24 @@ Script for running a one-way linear model on two sets of SAM/BAM files
 of aligned reads.  The transcripts in each file must be identical.
 The result is an SQLite database containing all the intermediate work,
 plus the final posteriors from the analysis.
+
+With -r, an existing database left by a run that was stopped partway
+is picked up again: files not yet loaded are loaded, and only the
+subproblems whose posteriors were never written are sampled.  With -c
+as well, the chains of large subproblems are checkpointed as they run
+and continued from where they stopped.
+
+With -e, each subproblem is sampled in several chains until every
+trace reaches the given effective sample size, instead of for a fixed
+number of iterations.  Either way, the effective sample size and
+R-hat of every trace are written to convergence_diagnostics.
+
+With --map, there is no sampling: every subproblem is moved to its
+posterior mode, and draws from the Laplace approximation there are
+written as an inference with method 'map'.  This takes minutes for a
+whole transcriptome.  With -R p as well, the subproblems holding any
+transcript the screen flags (see flagged_transcripts) are then
+sampled in full by the method given with -m.
 """
 
 import getopt
@@ -14,11 +32,37 @@ import os
 import sys
 import sqlite3
 from rnaseq import *
+from rnaseq.posteriors import posteriors_of_traces, completed_subproblems, \
+    flagged_transcripts
+from rnaseq.subproblems import rebuild_subproblems
+import rnaseq.instrument as instrument
 
-usage = """simple_inference.py [-vh] db group1 group2
+usage = """simple_inference.py [-vhBr] [-j n] [-m method] [-n n_samples] [-s store] [-c dir] [-e ess] [--map [-R p]] [--profile file] [--cprofile file] db group1 group2
 
 -v             Run verbosely
 -h             Print this message and exit
+-j n           Load files and sample subproblems in n processes at once
+-n n_samples   Produce n_samples samples of the posterior.
+-B             Store each trace as one BLOB in posterior_traces instead
+               of one row per sample in posterior_samples
+-m method      Build the model with 'pymc' (the default), 'vector' or
+               'native' (see build_model)
+-s store       Keep leftsites in a columnar sample store in the directory
+               'store' instead of in SQLite
+-r             Resume a run that stopped partway through, using the
+               existing database 'db'
+-c dir         Checkpoint the chains of subproblems of 100 or more
+               transcripts to files in 'dir' (only with -m native)
+-e ess         Sample each subproblem until every trace has an
+               effective sample size of ess, instead of for n_samples
+               (only with -m native)
+--map          Only find the posterior mode and its Laplace approximation
+-R p           After --map, sample in full the subproblems with a
+               transcript whose P(a>0) is at least p or at most 1-p
+--profile file Write timings and counts of this run to 'file' as JSON
+--cprofile file
+               Run the largest subproblem in this process under
+               cProfile, and save the statistics to 'file'
 db             The SQLite3 database to write to.
 group1,group2  Comma separated list of SAM/BAM files to use as samples
                for the two conditions
@@ -32,6 +76,17 @@ class State(object):
     def __init__(self):
         self.verbose = False
         self.n_samples = 500
+        self.store_path = None
+        self.method = 'pymc'
+        self.workers = 1
+        self.blobs = False
+        self.resume = False
+        self.checkpoint_dir = None
+        self.target_ess = None
+        self.map = False
+        self.refine = None
+        self.profile = None
+        self.cprofile = None
 
 state = State()
 
@@ -39,12 +94,84 @@ def vmsg(msg):
     if state.verbose:
         print >>sys.stderr, msg
 
+def sample_group(db, label):
+    """Return the ID of the sample group called *label*, creating it if needed."""
+    q = db.execute("""select id from sample_group where label=?""",
+                   (label,)).fetchone()
+    if q != None:
+        return q[0]
+    return insert_sample_group(db, label, False)
+
+def unloaded_files(db, filenames, group):
+    """Return the files of *filenames* not yet loaded into *group*."""
+    loaded = set([f for (f,) in
+                  db.execute("""select filename from samples
+                                where sample_group=? and n_reads is not null""",
+                             (group,))])
+    extra = loaded - set(filenames)
+    if extra != set():
+        raise Usage("Database has files not given for this run: %s" % \
+                        ', '.join(sorted(extra)))
+    return [f for f in filenames if not(f in loaded)]
+
+def run_inference(db, db_filename, group1_id, group2_id, subproblems, method):
+    """Sample *subproblems* by *method* into their inference in *db*.
+
+    Subproblems already completed in that inference are skipped.
+    Returns the ID of the inference.
+    """
+    if method == 'map':
+        inference = insert_inference(db, group1_id, group2_id, method='map')
+    else:
+        inference = insert_inference(db, group1_id, group2_id)
+    db.commit()
+
+    done = completed_subproblems(db, inference)
+    todo = [sp for sp in subproblems if not(min(sp) in done)]
+    vmsg("%d of %d subproblems already done by %s" % \
+             (len(subproblems)-len(todo), len(subproblems), method))
+
+    # Workers only read the database, and all the writing happens
+    # here as their results come back.
+    if method == 'map':
+        checkpoint_dir = target_ess = None
+    else:
+        checkpoint_dir = state.checkpoint_dir
+        target_ess = state.target_ess
+    def _sample(subproblems, workers):
+        return sample_subproblems(db_filename, group1_id, group2_id,
+                                  subproblems, n_samples=state.n_samples,
+                                  method=method, workers=workers,
+                                  checkpoint_dir=checkpoint_dir,
+                                  target_ess=target_ess)
+    def _write(results):
+        for transcripts,traces,diagnostics in results:
+            vmsg("Finished inference on transcripts %s" % ', '.join([str(t) for t in transcripts]))
+            write_posteriors(db, inference, posteriors_of_traces(traces),
+                             blobs=state.blobs, subproblem=transcripts,
+                             diagnostics=diagnostics)
+    if state.cprofile != None and todo != []:
+        # The pool's workers can't be profiled from here, so the
+        # largest subproblem is run in this process by itself.  Only
+        # the first step of the iterator is profiled, which samples
+        # it; the next step removes its checkpoint, so that waits
+        # until the posteriors are written.
+        largest = max(todo, key=len)
+        profiled = _sample([largest], 1)
+        _write([instrument.profile_call(state.cprofile, profiled.next)])
+        _write(profiled)
+        todo = [sp for sp in todo if not(sp is largest)]
+    _write(_sample(todo, state.workers))
+    return inference
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     try:
         try:
-            opts, args = getopt.getopt(argv, "hvn:", ["help","verbose"])
+            opts, args = getopt.getopt(argv, "hvBrj:m:n:s:c:e:R:",
+                                       ["help","verbose","map",
+                                        "profile=","cprofile="])
         except getopt.error, message:
             raise Usage(message)
         for o, a in opts:
@@ -60,17 +187,66 @@ def main(argv=None):
                     state.n_samples = int(a)
                 except ValueError, v:
                     raise Usage("Number of samples must be an integer, found %s" % a)
+            elif o in ("-j", ):
+                try:
+                    state.workers = int(a)
+                except ValueError, v:
+                    raise Usage("Number of jobs must be an integer, found %s" % a)
+            elif o in ("-B", ):
+                state.blobs = True
+            elif o in ("-s", ):
+                state.store_path = a
+            elif o in ("-r", ):
+                state.resume = True
+            elif o in ("-c", ):
+                state.checkpoint_dir = a
+            elif o in ("-e", ):
+                try:
+                    state.target_ess = int(a)
+                except ValueError, v:
+                    raise Usage("Effective sample size must be an integer, found %s" % a)
+            elif o in ("--map", ):
+                state.map = True
+            elif o in ("--profile", ):
+                state.profile = a
+            elif o in ("--cprofile", ):
+                state.cprofile = a
+            elif o in ("-R", ):
+                try:
+                    state.refine = float(a)
+                except ValueError, v:
+                    raise Usage("Probability must be a number, found %s" % a)
+            elif o in ("-m", ):
+                if not(a in ('pymc', 'vector', 'native')):
+                    raise Usage("Method must be one of pymc, vector or native, found %s" % a)
+                state.method = a
             else:
                 raise Usage("Unhandled option: " + o)
         if len(args) < 3:
             raise Usage("simple_inference.py takes at least three arguments.")
+        if state.profile != None:
+            instrument.enable()
+        if state.refine != None and not(state.map):
+            raise Usage("-R only makes sense with --map.")
+        if state.checkpoint_dir != None and state.method != 'native':
+            raise Usage("Checkpointing with -c needs -m native.")
+        if state.target_ess != None and state.method != 'native':
+            raise Usage("Sampling to an effective sample size with -e needs -m native.")
 
         db_filename = args[0]
         if os.path.exists(db_filename):
-            raise Usage("Database file %s already exists." % db_filename)
-        db = sqlite3.connect(db_filename)
-        initialize_database(db)
-        vmsg("Initialized database %s" % db_filename)
+            if not(state.resume):
+                raise Usage("Database file %s already exists.  Use -r to resume a run." % db_filename)
+            if state.store_path != None:
+                raise Usage("A sample store can only be given with a new database.")
+            db = instrument.connect(db_filename)
+            vmsg("Resuming from database %s" % db_filename)
+        else:
+            db = instrument.connect(db_filename)
+            initialize_database(db, state.store_path)
+            vmsg("Initialized database %s" % db_filename)
+        if state.checkpoint_dir != None and not(os.path.exists(state.checkpoint_dir)):
+            os.makedirs(state.checkpoint_dir)
 
         group1_files = args[1].split(',')
         group2_files = args[2].split(',')
@@ -78,45 +254,39 @@ def main(argv=None):
             if not(os.path.exists(f)):
                 raise Usage("Input file %s does not exist." % f)
 
-        group1_id = insert_sample_group(db, 'Group 1', False)
-        group2_id = insert_sample_group(db, 'Group 2', False)
-
-        vmsg("Adding group 1 files:")
-        for f in group1_files:
-            load_sam(db, f, group1_id)
-            vmsg("Loaded %s" % f)
+        group1_id = sample_group(db, 'Group 1')
+        group2_id = sample_group(db, 'Group 2')
 
-        vmsg("Adding group 2 files:")
-        for f in group2_files:
-            load_sam(db, f, group2_id)
-            vmsg("Loaded %s" % f)
-
-        db.execute("""insert into inferences (id,group1,group2) 
-                      values (1,?,?)""",
-                   (group1_id, group2_id))
-        db.commit()
+        group1_files = unloaded_files(db, group1_files, group1_id)
+        group2_files = unloaded_files(db, group2_files, group2_id)
+        load_sams(db, group1_files, group1_id, workers=state.workers)
+        vmsg("Loaded group 1 files: %s" % ', '.join(group1_files))
+        load_sams(db, group2_files, group2_id, workers=state.workers)
+        vmsg("Loaded group 2 files: %s" % ', '.join(group2_files))
+        if state.resume:
+            # A database written before samples and subproblems were
+            # committed together may have stopped between the two,
+            # even if every file was loaded.
+            rebuild_subproblems(db)
 
         subproblems = find_subproblems(db)
+        if not(state.map):
+            run_inference(db, db_filename, group1_id, group2_id,
+                          subproblems, state.method)
+        else:
+            screen = run_inference(db, db_filename, group1_id, group2_id,
+                                   subproblems, 'map')
+            if state.refine != None:
+                flagged = set(flagged_transcripts(db, screen, state.refine))
+                vmsg("Screen flagged %d transcripts" % len(flagged))
+                run_inference(db, db_filename, group1_id, group2_id,
+                              [sp for sp in subproblems
+                               if flagged.intersection(sp) != set()],
+                              state.method)
 
-        for transcripts in subproblems:
-            vmsg("Doing inference on transcripts %s" % ', '.join([str(t) for t in transcripts]))
-            M = build_model(db, group1_id, group2_id, transcripts)
-            M.sample(state.n_samples*5 + 2000, burn=2000, thin=5)
-            for t in transcripts:
-                mm = M.trace('minusmu%d' % t)[:]
-                for i,v in enumerate(mm):
-                    db.execute("""insert into posterior_samples
-                                  (inference,transcript,variable,sample,value)
-                                  values (1,?,'mu',?,?)""",
-                               (t,i,-1*v))
-                a = M.trace('a%d' % t)[:]
-                for i,v in enumerate(a):
-                    db.execute("""insert into posterior_samples
-                                  (inference,transcript,variable,sample,value)
-                                  values (1,?,'a',?,?)""",
-                               (t,i,v))
-                db.commit()
-
+        if state.profile != None:
+            instrument.write_report(state.profile,
+                                    database_bytes=os.path.getsize(db_filename))
         return 0
     except Usage, err:
         print >>sys.stderr, err.msg
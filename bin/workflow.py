@@ -15,12 +15,20 @@ import sqlite3
 from bbcflib import *
 from bein.util import *
 from rnaseq import *
+from rnaseq.subproblems import pack_subproblems, write_subproblems
+from rnaseq.posteriors import swap_groups
+import rnaseq.instrument as instrument
 
-usage = """workflow.py [-vh] [-l readlen] working_lims config_lims job_key
+usage = """workflow.py [-vh] [-l readlen] [-j n] [-b n] [--profile file] working_lims config_lims job_key
 
 -v           Run verbosely
 -h           Print this message and exit
 -l readlen   Reads have length 'readlen' in SAM/BAM files
+-j n         Parse up to n SAM/BAM files at once when loading the database
+-b n         Pack the subproblems into n inference jobs per pair of groups
+--profile file
+             Write timings and counts of this process to 'file' as JSON.
+             The inference jobs on LSF are not included.
 working_lims MiniLIMS where RNASeq executions and files will be stored.
 config_lims  MiniLIMS containing a pickled ConfigParser under the alias 'config'
 job_key      Alphanumeric key specifying the job
@@ -38,6 +46,9 @@ class State(object):
         self.config_lims = None
         self.job_key = None
         self.config = None
+        self.workers = 1
+        self.n_batches = 100
+        self.profile = None
 
 state = State()
 
@@ -50,8 +61,9 @@ def main(argv=None):
         argv = sys.argv[1:]
     try:
         try:
-            opts, args = getopt.getopt(argv, "hvl:", 
-                                       ["help","read-length"])
+            opts, args = getopt.getopt(argv, "hvl:j:b:", 
+                                       ["help","read-length","jobs=",
+                                        "batches=","profile="])
         except getopt.error, message:
             raise Usage(message)
         for o, a in opts:
@@ -68,8 +80,22 @@ def main(argv=None):
                     vmsg("Using read length %d" % state.read_length)
                 except ValueError, v:
                     raise Usage("Read length must be an integer, found %s" % a)
+            elif o in ("-j", "--jobs"):
+                try:
+                    state.workers = int(a)
+                except ValueError, v:
+                    raise Usage("Number of jobs must be an integer, found %s" % a)
+            elif o in ("-b", "--batches"):
+                try:
+                    state.n_batches = int(a)
+                except ValueError, v:
+                    raise Usage("Number of batches must be an integer, found %s" % a)
+            elif o in ("--profile", ):
+                state.profile = a
             else:
                 raise Usage("Unhandled option: " + o)
+        if state.profile != None:
+            instrument.enable()
         if len(args) != 3:
             raise Usage("samfiles_to_sqlite.py takes exactly three arguments.")
         try:
@@ -104,14 +130,14 @@ def main(argv=None):
 
         # Build database for inference from DAF LIMS files.
         # Fetch all the FASTQ files from the DAF LIMS, run bowtie on
-        # them, then load_sam on each of them.  Bowtie is run in
-        # parallel, but load_sam unfortunately has to be done in
-        # sequence due to database locking issues.
+        # them, then load_sams on each group.  Bowtie is run in
+        # parallel, and load_sams parses the SAM files in parallel
+        # while writing to the database from this process alone.
         daflims = DAFLIMS(username='jrougemont', password='cREThu6u')
         vmsg("Connected to DAF LIMS")
         with execution(state.working_lims) as ex:
             db_name = unique_filename_in()
-            db = sqlite3.connect(db)
+            db = instrument.connect(db_name)
             initialize_database(db)
             fastqfiles = {}
             for gid,g in job.groups.iteritems():
@@ -131,7 +157,8 @@ def main(argv=None):
             samfile_futures = deepmap(_align, fastqfiles)
             samfiles = deepmap(lambda q: q.wait(), samfile_futures)
             for gid in fastqfiles.keys():
-                [load_sam(db, f, gid) for f in fastqfiles[gid].itervalues()]
+                load_sams(db, samfiles[gid].values(), gid,
+                          workers=state.workers)
             ex.add(db_name)
             vmsg("Finished loading SAM files into database.")
 
@@ -145,9 +172,11 @@ def main(argv=None):
             if all([x['control'] for x in job.groups.itervalues()]) or \
                     not(any([x['control'] for x in job.groups.itervalues()])):
                 # case: all are control or none are control
+                # Each unordered pair once: (y,x) would only repeat
+                # (x,y) with the sign of a flipped.
                 pairs = [(x,y) for x in job.groups.iterkeys()
                          for y in job.groups.iterkeys()
-                         if x != y]
+                         if x < y]
                 vmsg("Going to run all against all: %s" % str(pairs))
             else:
                 # case: mixed
@@ -158,9 +187,18 @@ def main(argv=None):
                 pairs = [(x,y) for x in control_group_ids for y in other_group_ids]
                 vmsg("Going to run control against non-control: %s" % str(pairs))
 
-            # Submit each subproblem of each pair to LSF to leave a pickle file.
-            jobs = [inference.lsf(ex, db_name, p[0], p[1], sp)
-                    for p in pairs for sp in subproblems]
+            # Most subproblems are single transcripts, so running each
+            # in its own job costs more in startup than in sampling.
+            # Pack them into batches of about equal cost, and submit
+            # each batch to LSF to leave a pickle file.  Each job does
+            # every pair, so each sample is read once per batch.
+            batch_files = []
+            for batch in pack_subproblems(subproblems, state.n_batches):
+                batch_file = unique_filename_in()
+                write_subproblems(batch_file, batch)
+                batch_files.append(batch_file)
+            jobs = [inference.lsf(ex, db_name, pairs, bf)
+                    for bf in batch_files]
             pickle_files = [j.wait() for j in jobs]
 
             # Add pickle files to database
@@ -169,6 +207,9 @@ def main(argv=None):
 
             db.close()
             ex.add(db_name, "Database of posteriors")
+            if state.profile != None:
+                instrument.write_report(state.profile,
+                                        database_bytes=os.path.getsize(db_name))
 
         # Send a report email of the run
         # Wait until I switch to the configparser approach
@@ -182,40 +223,43 @@ def main(argv=None):
         return 2
 
 @program
-def inference(dbname, group1, group2, transcripts):
-    """Runs inference.py on *transcripts* in *group1* and *group2*
+def inference(dbname, pairs, subproblems_file):
+    """Runs inference.py on the subproblems in *subproblems_file* for each of *pairs*
 
     *dbname* is a path to an SQLite3 database, which will be treated
-    as read only.  The results are written in
-    *group1*-*group2*_*transcripts*.pickle, where *transcripts*
-    separates each element of the list with a '-'.
+    as read only.  *pairs* is a list of (group1, group2) tuples.
+    *subproblems_file* lists the subproblems as written by
+    write_subproblems.  The results are written in
+    *subproblems_file*.pickle.
     """
-    output = "%d-%d_%s.pickle" % (group1,group2,
-                                  "-".join([str(t) for t in transcripts]))
-    return {"arguments": ["inference.py","-v","-o",output,dbname,
-                          str(group1),str(group2)] + \
-                [str(t) for t in transcripts],
+    output = "%s.pickle" % os.path.basename(subproblems_file)
+    extra_pairs = []
+    for (g1,g2) in pairs[1:]:
+        extra_pairs.extend(["-p", "%d:%d" % (g1,g2)])
+    return {"arguments": ["inference.py","-v","-f",subproblems_file] + \
+                extra_pairs + [output,dbname,str(pairs[0][0]),str(pairs[0][1])],
             "return_value": output}
 
-def write_pickle(db, pickle_file):
+def write_pickle(db, pickle_file, blobs=False):
+    """Add the posteriors in *pickle_file*, written by inference.py, to *db*.
+
+    The pickle holds either one (group1, group2, posteriors) tuple or
+    a list of them, one per pair of groups.  Several pickles for the
+    same pair of groups all go into the same inference.  A pair with
+    the larger group first, as control against non-control pairs can
+    be, is stored the other way round with a negated.  *blobs* is
+    passed on to write_posteriors.
+    """
     with open(pickle_file) as pf:
-        (g1,g2,posteriors) = pickle.load(pf)
-    db.execute("""insert into inferences(group1,group2)
-                  values (?,?)""",
-               (min(g1,g2), max(g1,g2)))
-    inference_id = db.execute("""select last_insert_rowid()""").fetchone()[0]
-    for t,samples in posteriors.iteritems():
-        for i,v in enumerate(samples['mu']):
-            db.execute("""insert into posterior_samples 
-                          (inference,transcript,variable,sample,value)
-                          values (?,?,?,?,?)""",
-                       (inference_id, t, 'mu', i, v))
-        for i,v in enumerate(samples['a']):
-            db.execute("""insert into posterior_samples 
-                          (inference,transcript,variable,sample,value)
-                          values (?,?,?,?,?)""",
-                       (inference_id, t, 'a', i, v))
-    db.commit()
+        results = pickle.load(pf)
+    if isinstance(results, tuple):
+        results = [results]
+    for (g1,g2,posteriors) in results:
+        if g1 > g2:
+            (g1, g2) = (g2, g1)
+            posteriors = swap_groups(posteriors)
+        inference_id = insert_inference(db, g1, g2)
+        write_posteriors(db, inference_id, posteriors, blobs=blobs)
         
 
 
@@ -2,6 +2,12 @@
 A set of functions for doing RNASeq analysis.
 """
 
-from model import build_model
-from load import initialize_database, insert_sample_group, load_sam
+from model import build_model, posterior_traces, sample_posterior, \
+    load_groups, sample_comparisons, build_oneway_model, comparison_traces
+from load import initialize_database, insert_sample_group, load_sam, \
+    load_sams, finalize_database
 from subproblems import find_subproblems
+from parallel import sample_subproblems
+from diagnostics import diagnose, sample_until_converged
+from posteriors import insert_inference, write_posteriors, read_posterior, \
+    decode_trace, rank_transcripts, flagged_transcripts
@@ -1,68 +1,110 @@
-class Bag(object):
-    def __init__(self, iterable=[]):
-        # start empty, then add the `iterable' if any
-        self._data = {}
-        self.update(iterable)
-    def update(self, iterable):
-        # update from an element->count mapping, or from any iterable
-        if isinstance(iterable, dict):
-            for elem, n in iterable.iteritems( ):
-                self[elem] += n
+import numpy as np
+
+class TargetSets(object):
+    """Interned tuples of target transcripts, numbered from zero.
+
+    Many multiplicities share the same targets, so each distinct tuple
+    is stored once and referred to by its number.  One TargetSets is
+    shared by all the MultiplicityTables read together.
+    """
+    __slots__ = ['ids', 'sets']
+    def __init__(self):
+        self.ids = {}
+        self.sets = []
+    def intern(self, targets):
+        # return the number of `targets', adding it if it is new
+        i = self.ids.get(targets)
+        if i is None:
+            i = len(self.sets)
+            self.ids[targets] = i
+            self.sets.append(targets)
+        return i
+    def __getitem__(self, i):
+        return self.sets[i]
+    def __len__(self):
+        return len(self.sets)
+    def __getstate__(self):
+        return self.sets
+    def __setstate__(self, sets):
+        self.sets = sets
+        self.ids = dict([(ts,i) for i,ts in enumerate(sets)])
+
+class MultiplicityTable(object):
+    """The multiplicities of one transcript in one sample.
+
+    Entry i is a multiread starting at leftsite positions[i] of the
+    transcript, also aligned to the transcripts target_sets[set_ids[i]],
+    which occurs counts[i] times.  The three are parallel numpy
+    arrays, with no two entries sharing both a position and a target
+    set, so the table costs a few dozen bytes per entry where a
+    dictionary of (position, targets) tuples would cost hundreds.
+    itercounts yields ((position, targets), count) pairs, iterunique
+    the (position, targets) keys, and len the total count, which is
+    computed once.
+    """
+    __slots__ = ['target_sets', 'positions', 'set_ids', 'counts', '_length']
+    def __init__(self, target_sets=None, positions=(), set_ids=(), counts=None):
+        # entries with the same position and target set are merged,
+        # adding their counts, which default to one each
+        if target_sets is None:
+            target_sets = TargetSets()
+        positions = np.asarray(positions, dtype=np.intp)
+        set_ids = np.asarray(set_ids, dtype=np.intp)
+        if counts is None:
+            counts = np.ones(len(positions))
         else:
-            for elem in iterable:
-                self[elem] += 1 
-    def __contains__(self, elem):
-        # delegate membership test
-        return elem in self._data
-    def __getitem__(self, elem):
-        # default all missing items to a count of 0
-        return self._data.get(elem, 0)
-    def __setitem__(self, elem, n):
-        # setting an item to a count of 0 removes the item
-        self._data[elem] = n
-        if n == 0:
-            del self._data[elem]
-    def __delitem__(self, elem):
-        # delegate to __setitem__ to allow deleting missing items
-        self[elem] = 0
+            counts = np.asarray(counts, dtype=float)
+        if len(positions) > 1:
+            order = np.lexsort((set_ids, positions))
+            (positions, set_ids, counts) = \
+                (positions[order], set_ids[order], counts[order])
+            first = np.flatnonzero(np.concatenate([[True],
+                                                   (np.diff(positions) != 0) |
+                                                   (np.diff(set_ids) != 0)]))
+            counts = np.add.reduceat(counts, first)
+            (positions, set_ids) = (positions[first], set_ids[first])
+        self.target_sets = target_sets
+        self.positions = positions
+        self.set_ids = set_ids
+        self.counts = counts
+        self._length = int(np.sum(counts))
     def __len__(self):
-        # length is computed on-the-fly
-        return sum(self._data.itervalues( ))
+        return self._length
     def __nonzero__(self):
-        # avoid truth tests using __len__, as it's relatively slow
-        return bool(self._data)
-    def __eq__(self, other):
-        # a bag can only equal another bag
-        if not isinstance(other, bag):
-            return False
-        return self._data == other._data
-    def __ne__(self, other):
-        # a bag always differs from any non-bag
-        return not (self == other)
-    def __hash__(self):
-        # a bag can't be a dict key nor an element in a set
-        raise TypeError
+        return len(self.positions) > 0
     def __repr__(self):
-        # typical string-representation
-        return '%s(%r)' % (self.__class__.__name__, self._data)
-    def copy(self):
-        # make and return a shallow copy
-        return self.__class__(self._data)
-    __copy__ = copy # For the copy module
-    def clear(self):
-        # remove all items
-        self._data.clear( )
-    def __iter__(self):
-        # yield each element the # of times given by its count
-        for elem, cnt in self._data.iteritems():
-            for i in xrange(cnt):
-                yield elem
-    def iterunique(self):
-        # yield each element only once
-        return self._data.iterkeys()
+        return '%s(%r)' % (self.__class__.__name__, dict(self.itercounts()))
     def itercounts(self):
-        # yield element-count pairs
-        return self._data.iteritems()
+        for p,i,n in zip(self.positions, self.set_ids, self.counts):
+            yield ((int(p), self.target_sets[i]), int(n))
+    def iterunique(self):
+        for (key, n) in self.itercounts():
+            yield key
+    def set_arrays(self, index=None):
+        """Return the target sets used by this table in flat form.
+
+        Returns a tuple (set_ids, targets, starts).  The distinct sets
+        in the table are numbered from zero, 'set_ids' gives the new
+        number of the set of each entry, and the targets of set j are
+        targets[starts[j]:starts[j+1]] (or to the end of 'targets' for
+        the last set), each mapped through the dictionary 'index' if
+        it is given.
+        """
+        (used, local) = np.unique(self.set_ids, return_inverse=True)
+        targets = []
+        starts = []
+        for i in used:
+            starts.append(len(targets))
+            ts = self.target_sets[i]
+            targets.extend(ts if index is None else [index[k] for k in ts])
+        return (np.asarray(local, dtype=np.intp),
+                np.array(targets, dtype=np.intp),
+                np.array(starts, dtype=np.intp))
+    def __getstate__(self):
+        return (self.target_sets, self.positions, self.set_ids, self.counts)
+    def __setstate__(self, state):
+        (self.target_sets, self.positions, self.set_ids, self.counts) = state
+        self._length = int(np.sum(self.counts))
 
 def group_by_first(s):
     prev = None
@@ -0,0 +1,162 @@
+"""
+Convergence diagnostics, and sampling until they are met.
+
+A fixed chain length is wasted on most subproblems: a single well
+covered transcript mixes in a few hundred sweeps, while a large
+cluster of transcripts linked by multireads may need many thousands.
+sample_until_converged runs several NativeSampler chains side by side,
+a batch of sweeps at a time, and stops as soon as every trace has
+reached a target effective sample size and its split R-hat is close
+to one.
+
+Both diagnostics follow Gelman et al., Bayesian Data Analysis, 3rd
+edition, section 11.4-11.5: the effective sample size combines the
+autocorrelations of all chains and truncates their sum by Geyer's
+initial monotone sequence, and R-hat compares the variance within and
+between chains split in half.
+"""
+
+import os
+import numpy as np
+import instrument
+from model import build_native_sampler, load_groups, save_checkpoint, \
+    load_checkpoint
+
+def autocovariance(x):
+    """Return the autocovariance of *x* at every lag, computed by FFT."""
+    n = len(x)
+    f = np.fft.rfft(x - np.mean(x), 2*n)
+    return np.fft.irfft(f * np.conjugate(f))[:n] / n
+
+def effective_sample_size(chains):
+    """Return the effective sample size of *chains*, an m by n array.
+
+    A trace that never moves has no autocorrelation to speak of, and
+    is given an effective sample size of m*n.
+    """
+    chains = np.atleast_2d(np.asarray(chains, dtype=float))
+    (m, n) = chains.shape
+    if n < 4:
+        return 0.0
+    acov = np.array([autocovariance(c) for c in chains])
+    mean_var = np.mean(acov[:,0]) * n / (n - 1.0)
+    var_plus = mean_var * (n - 1.0) / n
+    if m > 1:
+        var_plus += np.var(np.mean(chains, axis=1), ddof=1)
+    if var_plus <= 0:
+        return float(m*n)
+    rho = 1 - (mean_var - np.mean(acov, axis=0)) / var_plus
+    rho[0] = 1
+    # Sum the autocorrelations in pairs while the pairs stay positive,
+    # never letting a pair exceed the one before it.
+    tau = -1.0
+    last = np.inf
+    for k in range(0, n-1, 2):
+        pair = rho[k] + rho[k+1]
+        if pair <= 0:
+            break
+        last = min(last, pair)
+        tau += 2*last
+    return float(m*n / max(tau, 1.0/np.log10(m*n)))
+
+def split_rhat(chains):
+    """Return the split R-hat of *chains*, an m by n array.
+
+    Each chain is cut in half, so a single chain that is still
+    drifting shows up as two chains that disagree.
+    """
+    chains = np.atleast_2d(np.asarray(chains, dtype=float))
+    half = chains.shape[1] // 2
+    if half < 2:
+        return np.inf
+    halves = np.vstack([chains[:,:half], chains[:,-half:]])
+    W = np.mean(np.var(halves, axis=1, ddof=1))
+    B = half * np.var(np.mean(halves, axis=1), ddof=1)
+    if W <= 0:
+        return 1.0 if B <= 0 else np.inf
+    return float(np.sqrt(((half - 1.0)/half * W + B/half) / W))
+
+def diagnose(traces, n_chains=1):
+    """Compute the convergence diagnostics of *traces*.
+
+    *traces* is a dictionary of transcripts to dictionaries of
+    variables to numpy arrays, as returned by posterior_traces or
+    posteriors_of_traces, each holding *n_chains* chains of equal
+    length laid end to end.  Returns a dictionary of the same shape
+    whose values are tuples (ess, rhat, n_chains, n_draws).
+    """
+    r = {}
+    for t,variables in traces.iteritems():
+        r[t] = {}
+        for variable,trace in variables.iteritems():
+            chains = np.reshape(trace, (n_chains, -1))
+            r[t][variable] = (effective_sample_size(chains),
+                              split_rhat(chains), n_chains, len(trace))
+    return r
+
+def converged(diagnostics, target_ess=400, max_rhat=1.01):
+    """Check that every trace in *diagnostics* meets both targets."""
+    return all([ess >= target_ess and rhat <= max_rhat
+                for variables in diagnostics.itervalues()
+                for (ess, rhat, n_chains, n_draws) in variables.itervalues()])
+
+def sample_until_converged(db, group1, group2, transcripts, target_ess=400,
+                           max_rhat=1.01, n_chains=4, burn=1000, batch=500,
+                           thin=5, max_sweeps=100000, loaded=None,
+                           checkpoint=None, overdispersion=1.0, seed=None):
+    """Sample the posterior of 'transcripts' until it has converged.
+
+    Runs *n_chains* NativeSamplers comparing *group1* and *group2*,
+    each tuning its step sizes for *burn* sweeps, then adds *batch*
+    sweeps to every chain, keeping every *thin*th, until converged
+    holds for *target_ess* and *max_rhat* or each chain has run
+    *max_sweeps* sweeps.  Each chain starts from its own point, moved
+    away from the common starting point by NativeSampler.overdisperse
+    with *overdispersion* as the scale, drawn from its own seed taken
+    from *seed*, so that R-hat can see any dependence on where the
+    chains started.  *loaded* is as for build_model.  If
+    *checkpoint* is given, the chains are saved to that file after
+    every batch and continued from it if it exists, as for
+    sample_posterior.
+
+    Returns a pair (traces, diagnostics): the chains of each trace
+    laid end to end, as posterior_traces returns them, and diagnose
+    of those traces.
+    """
+    if checkpoint != None and os.path.exists(checkpoint):
+        chains = load_checkpoint(checkpoint)
+        if chains[0].transcripts != list(transcripts):
+            raise ValueError("Checkpoint %s is of transcripts %s, not %s" % \
+                                 (checkpoint, chains[0].transcripts,
+                                  list(transcripts)))
+    else:
+        if loaded == None:
+            loaded = load_groups(db, [group1, group2], transcripts)
+        with instrument.timer('build_model'):
+            chains = [build_native_sampler(db, group1, group2, transcripts,
+                                           loaded=loaded)
+                      for i in range(n_chains)]
+        seeds = np.random.RandomState(seed).randint(2**31 - 1, size=n_chains)
+        for M,chain_seed in zip(chains, seeds):
+            M.overdisperse(overdispersion, np.random.RandomState(chain_seed))
+    batch = max(thin, batch - batch % thin)
+    while True:
+        for M in chains:
+            done = M.n_sweeps
+            with instrument.timer('sample'):
+                if M.n_sweeps < burn:
+                    M.sweep(burn - M.n_sweeps, True)
+                M.sample(batch, thin=thin)
+            instrument.count('mcmc_iterations', M.n_sweeps - done)
+        if checkpoint != None:
+            save_checkpoint(chains, checkpoint)
+        chain_traces = [M.traces() for M in chains]
+        traces = dict([(t, dict([(v, np.concatenate([x[t][v]
+                                                     for x in chain_traces]))
+                                 for v in ('minusmu', 'a')]))
+                       for t in transcripts])
+        with instrument.timer('diagnose'):
+            diagnostics = diagnose(traces, len(chains))
+        if converged(diagnostics, target_ess, max_rhat) or \
+                chains[0].n_sweeps >= max_sweeps:
+            return (traces, diagnostics)
@@ -0,0 +1,132 @@
+"""
+Timers and counters showing where a run spends its time.
+
+Instrumentation is off until enable is called, and while it is off
+timer and count do nothing, so the library can be instrumented
+throughout at no cost to ordinary runs.  Every script in bin/ takes
+--profile FILE, which enables it and writes the report as JSON when
+the script finishes.
+
+Timers accumulate wall clock seconds and calls under a name, so a
+stage run once per sample or per subproblem adds up to one line.
+Counters accumulate anything else: reads parsed, SQL statements and
+rows, model nodes, MCMC iterations, bytes written.  The report also
+gives the rates which tell an I/O bound run from a sampler bound
+one.
+
+Only the process that calls enable is measured.  Worker processes
+started with -j keep their own counts, which are lost, so profile
+with one worker to see inside the pool.
+
+The name is not profile.py, which would hide the standard library
+module of that name from the rest of the package.
+"""
+
+import sys
+import time
+import json
+import sqlite3
+import cProfile
+import contextlib
+
+enabled = False
+started = None
+timers = {}
+counters = {}
+
+# Each rate is reported as the counter divided by the seconds of the
+# timer, if both were recorded.
+RATES = [('reads_per_second', 'reads_parsed', 'count_reads'),
+         ('iterations_per_second', 'mcmc_iterations', 'sample'),
+         ('sql_statements_per_second', 'sql_statements', 'sql')]
+
+def enable():
+    """Start recording, discarding anything recorded before."""
+    global enabled, started
+    enabled = True
+    started = time.time()
+    timers.clear()
+    counters.clear()
+
+def count(name, n=1):
+    """Add *n* to the counter *name*."""
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+@contextlib.contextmanager
+def timer(name):
+    """Add the time spent in a with block to the timer *name*."""
+    if not(enabled):
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        (seconds, calls) = timers.get(name, (0.0, 0))
+        timers[name] = (seconds + time.time() - start, calls + 1)
+
+def report(**extra):
+    """Return everything recorded as a dictionary, ready for JSON.
+
+    Keyword arguments are added to the report as they are.
+    """
+    r = {'argv': sys.argv,
+         'seconds': time.time() - started if started != None else 0.0,
+         'timers': dict([(name, {'seconds': seconds, 'calls': calls})
+                         for name,(seconds,calls) in timers.iteritems()]),
+         'counters': dict(counters),
+         'rates': {}}
+    for (rate, counter, timer_name) in RATES:
+        if counter in counters and timers.get(timer_name, (0,0))[0] > 0:
+            r['rates'][rate] = counters[counter] / timers[timer_name][0]
+    r.update(extra)
+    return r
+
+def write_report(filename, **extra):
+    """Write report(**extra) to *filename* as JSON."""
+    with open(filename, 'w') as f:
+        json.dump(report(**extra), f, indent=2, sort_keys=True)
+
+class CountingConnection(sqlite3.Connection):
+    """An SQLite3 connection which counts and times its statements.
+
+    Use it with sqlite3.connect(filename, factory=CountingConnection),
+    or through connect.  Statements run through cursors made with
+    cursor() are not seen.
+    """
+    def execute(self, *args):
+        count('sql_statements')
+        with timer('sql'):
+            return sqlite3.Connection.execute(self, *args)
+    def executemany(self, sql, rows):
+        count('sql_statements')
+        def _counted():
+            for row in rows:
+                count('sql_rows')
+                yield row
+        with timer('sql'):
+            return sqlite3.Connection.executemany(self, sql, _counted())
+    def executescript(self, script):
+        count('sql_statements')
+        with timer('sql'):
+            return sqlite3.Connection.executescript(self, script)
+
+def connect(filename):
+    """Open *filename*, counting its statements if instrumentation is on."""
+    if enabled:
+        return sqlite3.connect(filename, factory=CountingConnection)
+    else:
+        return sqlite3.connect(filename)
+
+def profile_call(filename, f, *args, **kwargs):
+    """Run *f* under cProfile, save the statistics to *filename*, and return its result.
+
+    Read the statistics with the pstats module, or a viewer such as
+    snakeviz.
+    """
+    p = cProfile.Profile()
+    try:
+        return p.runcall(f, *args, **kwargs)
+    finally:
+        p.dump_stats(filename)
@@ -1,9 +1,29 @@
+import os
+import shutil
 import sqlite3
+import tempfile
+import itertools
+import functools
+import collections
+import multiprocessing
 import pysam
+import numpy as np
+import store
+import instrument
+from subproblems import initialize_subproblems, update_subproblems, \
+    pack_subproblems
+from posteriors import initialize_completed, initialize_diagnostics
 
-def initialize_database(db):
+def initialize_database(db, store_path=None):
     """Set up the schema for SQLite3 handle *db*.
 
+    leftsites is sparse: it only has rows for positions where at least
+    one read starts.  Any position of a transcript without a row has a
+    count of zero.
+
+    If *store_path* is given, leftsites are written to a columnar
+    sample store in that directory instead of to the leftsites table
+    (see store.py).
     """
     db.execute("""
                create table sample_group (
@@ -54,7 +74,8 @@ def initialize_database(db):
                    id integer primary key,
                    group1 integer references sample_group(id),
                    group2 integer references sample_group(id),
-                   unique (group1,group2),
+                   method text not null default 'mcmc',
+                   unique (group1,group2,method),
                    check (group1 <= group2)
                )
                """)
@@ -68,7 +89,39 @@ def initialize_database(db):
                    primary key (inference,transcript,variable,sample)
                )
                """)
+    db.execute("""
+               create table posterior_traces (
+                   inference integer references inferences(id),
+                   transcript integer references transcripts(id),
+                   variable text not null,
+                   trace blob not null,
+                   primary key (inference,transcript,variable)
+               )
+               """)
+    db.execute("""
+               create table posterior_summaries (
+                   inference integer references inferences(id),
+                   transcript integer references transcripts(id),
+                   variable text not null,
+                   mean float not null,
+                   median float not null,
+                   lower float not null,
+                   upper float not null,
+                   p_positive float not null,
+                   primary key (inference,transcript,variable)
+               )
+               """)
+    db.execute("""
+               create table sample_store (
+                   path text not null
+               )
+               """)
+    initialize_subproblems(db)
+    initialize_completed(db)
+    initialize_diagnostics(db)
     db.commit()
+    if store_path != None:
+        store.initialize_store(db, store_path)
 
 def insert_sample_group(db, label, is_control, group_id=None):
     if group_id != None:
@@ -90,7 +143,7 @@ def insert_sample(db, filename, sample_group):
     (sample,) = db.execute("""select last_insert_rowid()""").fetchone()
     return sample
 
-def insert_or_check_transcripts(db, sample, transcripts):
+def insert_or_check_transcripts(db, transcripts, filename):
     if db.execute("""select count(id)>0 
                      from transcripts""").fetchone()[0] == 1:
         # Another call to load_sam has already loaded the transcripts
@@ -112,65 +165,394 @@ def insert_or_check_transcripts(db, sample, transcripts):
                                          "Database had label %s with " + \
                                          "length %d; file had label %s " + \
                                          "with length %d.") % (i,filename,
-                                                              h['SN'],h['LN'],
-                                                              label,length+38))
+                                                              label,length,
+                                                              h['SN'],h['LN']-38))
     else:
         # The database has no transcripts.  Insert them.
         for i,h in enumerate(transcripts):
             db.execute("""insert into transcripts(id,label,length)
                           values (?,?,?)""", (i,h['SN'],h['LN']-38))
 
-    for i,h in enumerate(transcripts):
-        for p in range(h['LN']-38+1): # Have to add 1 to get final leftsite
-            db.execute("""insert into leftsites(sample,transcript,position,n) 
-                          values (?,?,?,0)""", (sample,i,p))
 
+def insert_reads_and_multiplicities(db, sample, samfile, grouping='auto'):
+    """Write the leftsites of *samfile* to *db* read by read.
 
-def insert_reads_and_multiplicities(db, sample, samfile):
+    Only the multiplicities, one per distinct set of targets, are
+    kept in memory, and they are written with write_multiplicities
+    once the whole file has been read.  Returns the number of reads.
+    """
     n_reads = 0
-    for readset in split_by_readname(samfile):
+    multiplicities = {}
+    for readset in group_reads(samfile, grouping):
         n_reads += 1
         if len(readset) > 1:
-            targets = tuple([(r.rname,r.pos) for r in readset])
-            mid = (sample,targets).__hash__()
-            if db.execute("""select id from multiplicities where id=?""", (mid,)).fetchone() == None:
-                db.execute("""insert into multiplicities(id,sample,n)
-                              values (?,?,1)""", (mid, sample))
-                for (t,p) in targets:
-                    db.execute("""insert into multiplicity_entries 
-                                  (transcript,position,multiplicity) 
-                                  values (?,?,?)""", (t,p,mid))
-            else:
-                db.execute("""update multiplicities set n=n+1
-                              where id=?""", (mid,))
+            targets = canonical_targets(readset)
+            multiplicities[targets] = multiplicities.get(targets, 0) + 1
         for r in readset:
+            if r.is_unmapped:
+                continue
+            db.execute("""insert or ignore into leftsites
+                          (sample,transcript,position,n)
+                          values (?,?,?,0)""", (sample,r.rname,r.pos))
             db.execute("""update leftsites set n=n+1 where
                           sample=? and transcript=? and position=?""",
                        (sample,r.rname,r.pos))
+    write_multiplicities(db, sample, multiplicities)
     return n_reads
 
 
-def load_sam(db, filename, sample_group):
+def canonical_targets(readset):
+    """Return the (transcript,position) pairs of *readset* in sorted order.
+
+    This is the key of a multiplicity, so reads with the same
+    alignments share one multiplicity whatever order the alignments
+    came in.
+    """
+    return tuple(sorted([(r.rname,r.pos) for r in readset]))
+
+
+def count_reads_and_multiplicities(samfile, grouping='auto'):
+    """Accumulate the leftsites and multiplicities of *samfile* in memory.
+
+    Returns a tuple (n_reads, leftsites, multiplicities).  *leftsites*
+    is a list with one numpy array per transcript in the @SQ header of
+    *samfile*, giving the number of reads starting at each leftsite of
+    that transcript.  *multiplicities* is a dictionary whose keys are
+    the canonical_targets of each multiply mapped read, and whose
+    values are the number of reads with exactly those alignments.
+    Reads are grouped by group_reads(*samfile*, *grouping*).
+    """
+    leftsites = [np.zeros(h['LN']-38+1, dtype=np.int32)
+                 for h in samfile.header['SQ']]
+    multiplicities = {}
+    n_reads = 0
+    for readset in group_reads(samfile, grouping):
+        n_reads += 1
+        if len(readset) > 1:
+            targets = canonical_targets(readset)
+            multiplicities[targets] = multiplicities.get(targets, 0) + 1
+        for r in readset:
+            # Unaligned reads and leftsites past the end of the
+            # transcript are dropped.
+            if 0 <= r.rname < len(leftsites) and \
+                    0 <= r.pos < len(leftsites[r.rname]):
+                leftsites[r.rname][r.pos] += 1
+    return (n_reads, leftsites, multiplicities)
+
+
+def write_reads_and_multiplicities(db, sample, leftsites, multiplicities):
+    """Write leftsites and multiplicities accumulated in memory to *db*.
+
+    *leftsites* and *multiplicities* are as returned by
+    count_reads_and_multiplicities.  Each table is written in a single
+    executemany pass.  If *db* has a sample store, the leftsites and a
+    copy of the multiplicities go to the store instead.
+    """
+    path = store.store_path(db)
+    if path != None:
+        store.write_sample(path, sample, leftsites, multiplicities)
+    else:
+        def _leftsite_rows():
+            for t,counts in enumerate(leftsites):
+                for p in np.flatnonzero(counts):
+                    yield (sample, t, int(p), int(counts[p]))
+        db.executemany("""insert into leftsites(sample,transcript,position,n)
+                          values (?,?,?,?)""",
+                       _leftsite_rows())
+    write_multiplicities(db, sample, multiplicities)
+
+
+def write_multiplicities(db, sample, multiplicities):
+    """Write *multiplicities* of *sample* to *db*, numbering them in order.
+
+    *multiplicities* is as returned by count_reads_and_multiplicities.
+    The multiplicities are given sequential IDs following the largest
+    already in *db*, in sorted order of their targets, so loading the
+    same files in the same order gives the same database on any
+    machine.
+    """
+    (first,) = db.execute("""select coalesce(max(id),0)+1
+                             from multiplicities""").fetchone()
+    mids = [(first+i, targets, n)
+            for i,(targets,n) in enumerate(sorted(multiplicities.iteritems()))]
+    db.executemany("""insert into multiplicities(id,sample,n)
+                      values (?,?,?)""",
+                   ((mid,sample,n) for (mid,targets,n) in mids))
+    db.executemany("""insert into multiplicity_entries
+                      (transcript,position,multiplicity)
+                      values (?,?,?)""",
+                   ((t,p,mid) for (mid,targets,n) in mids
+                    for (t,p) in targets))
+
+
+def load_sam(db, filename, sample_group, in_memory=True, index=True,
+             grouping='auto', workers=1):
+    """Load the SAM/BAM file *filename* into *db* as a new sample.
+
+    The sample is added to *sample_group*.  If *in_memory* is True,
+    leftsites and multiplicities are accumulated in memory and
+    written to *db* in bulk at the end.  Otherwise each read is
+    written to *db* as it is read, which uses far less memory on very
+    large transcriptomes but issues several statements per read, and
+    is not available for databases with a sample store.  If *index*
+    is True, create_indexes is run on *db* once the sample is loaded.
+    *grouping* says how to find the alignments of each read, as for
+    group_reads; the default handles both bowtie's output and
+    coordinate sorted BAM files with NH tags, without sorting either.
+    If *workers* is more than one and *filename* is an indexed BAM
+    file, its references are counted in parallel by
+    count_indexed_bam, which needs NH tags, so *grouping* must be
+    'auto' or 'nh'.  Returns the ID of the new sample.
+    """
+    if not(in_memory) and store.store_path(db) != None:
+        raise ValueError("Databases with a sample store can only be loaded in memory.")
     s = pysam.Samfile(filename)
 
+    # Databases from before subproblems were stored need the table
+    # created here, outside the transaction that writes the sample.
+    initialize_subproblems(db)
     sample = insert_sample(db, filename, sample_group)
-    insert_or_check_transcripts(db, sample, s.header['SQ'])
-    n_reads = insert_reads_and_multiplicities(db, sample, s)
+    insert_or_check_transcripts(db, s.header['SQ'], filename)
+    if in_memory and workers > 1 and grouping in ('auto', 'nh') and \
+            is_indexed_bam(filename):
+        with instrument.timer('count_reads'):
+            (n_reads, leftsites, multiplicities) = \
+                count_indexed_bam(filename, workers)
+        with instrument.timer('write_reads'):
+            write_reads_and_multiplicities(db, sample, leftsites,
+                                           multiplicities)
+    elif in_memory:
+        with instrument.timer('count_reads'):
+            (n_reads, leftsites, multiplicities) = \
+                count_reads_and_multiplicities(s, grouping)
+        with instrument.timer('write_reads'):
+            write_reads_and_multiplicities(db, sample, leftsites,
+                                           multiplicities)
+    else:
+        with instrument.timer('insert_reads'):
+            n_reads = insert_reads_and_multiplicities(db, sample, s,
+                                                      grouping)
+    instrument.count('reads_parsed', n_reads)
     db.execute("""update samples set n_reads=? where id=?""",
                (n_reads, sample))
-            
+    # The sample and the subproblems it changes are committed
+    # together, so an interrupted load leaves neither.
+    update_subproblems(db, sample)
     db.commit()
     s.close()
+    if index:
+        create_indexes(db)
     return sample
 
 
+def count_samfile(filename, grouping='auto'):
+    """Open *filename* and return count_reads_and_multiplicities for it.
+
+    This is the work done by each worker process in load_sams.
+    """
+    s = pysam.Samfile(filename)
+    try:
+        return count_reads_and_multiplicities(s, grouping)
+    finally:
+        s.close()
+
+
+def is_indexed_bam(filename):
+    """Check if *filename* is a BAM file with an index beside it."""
+    return filename.endswith('.bam') and \
+        (os.path.exists(filename + '.bai') or
+         os.path.exists(filename[:-len('.bam')] + '.bai'))
+
+
+def count_region(filename, references):
+    """Count the alignments on *references* in the indexed BAM file *filename*.
+
+    *references* is a list of indices into the @SQ header.  This is
+    the work done by each worker process in count_indexed_bam.
+    Returns a tuple (n_reads, leftsites, multireads): *n_reads* is the
+    number of reads with a single alignment, *leftsites* is a list of
+    (reference, counts) pairs, with counts as in
+    count_reads_and_multiplicities, and *multireads* is a list of
+    (qname, reference, position) triples, one for each alignment of a
+    read with NH above one.
+    """
+    s = pysam.Samfile(filename)
+    try:
+        n_reads = 0
+        leftsites = []
+        multireads = []
+        for t in references:
+            counts = np.zeros(s.header['SQ'][t]['LN']-38+1, dtype=np.int32)
+            for r in s.fetch(s.references[t]):
+                if r.is_unmapped:
+                    # Counted from the index by count_indexed_bam.
+                    continue
+                if 0 <= r.pos < len(counts):
+                    counts[r.pos] += 1
+                if number_of_hits(r) <= 1:
+                    n_reads += 1
+                else:
+                    multireads.append((r.qname, t, r.pos))
+            leftsites.append((t, counts))
+        return (n_reads, leftsites, multireads)
+    finally:
+        s.close()
+
+
+def count_indexed_bam(filename, workers, tmpdir=None):
+    """Count the reads of the indexed BAM file *filename* in parallel.
+
+    Returns the same as count_reads_and_multiplicities, but the
+    references of *filename* are split into shards of about equal
+    total length, which a pool of *workers* processes count with
+    count_region.  Reads with a single alignment are finished in the
+    workers.  The alignments of multireads come back to this process,
+    which groups them by read name in a SpilledGroups, since the
+    alignments of one read may be on references in different shards.
+    Unmapped reads, including those placed on a reference, are
+    counted from the index rather than by the workers.  Every
+    aligned read must have an NH tag.
+    """
+    s = pysam.Samfile(filename)
+    lengths = [h['LN'] for h in s.header['SQ']]
+    n_reads = s.unmapped
+    s.close()
+    leftsites = [np.zeros(n-38+1, dtype=np.int32) for n in lengths]
+    # Several shards per worker, so one long reference at the end
+    # doesn't leave the other workers idle.
+    shards = [[t for [t] in job]
+              for job in pack_subproblems([[t] for t in range(len(lengths))],
+                                          4*workers,
+                                          cost=lambda sp: lengths[sp[0]])]
+    spill = SpilledGroups(tmpdir=tmpdir)
+    pool = multiprocessing.Pool(workers)
+    try:
+        for (n, counts, multireads) in \
+                pool.imap_unordered(functools.partial(count_region, filename),
+                                    shards):
+            n_reads += n
+            for t,c in counts:
+                leftsites[t] = c
+            for (qname, t, position) in multireads:
+                spill.add(Alignment(qname, t, position, False))
+        pool.close()
+        multiplicities = {}
+        for group in spill.groups():
+            n_reads += 1
+            if len(group) > 1:
+                targets = canonical_targets(group)
+                multiplicities[targets] = multiplicities.get(targets, 0) + 1
+    except:
+        pool.terminate()
+        raise
+    finally:
+        spill.close()
+        pool.join()
+    return (n_reads, leftsites, multiplicities)
+
+
+def load_sams(db, filenames, sample_group, workers=1, grouping='auto'):
+    """Load the SAM/BAM files *filenames* into *db* as new samples.
+
+    The samples are all added to *sample_group*.  The files are parsed
+    in parallel by a pool of *workers* processes, each of which
+    returns the leftsites and multiplicities of one file.  Only this
+    process writes to *db*, so there is never more than one writer.
+    Returns a list of the IDs of the new samples, in the same order as
+    *filenames*.  create_indexes is run once all the files are loaded.
+    *grouping* is as for load_sam.  A single file is passed to
+    load_sam with all the *workers*, to be counted by region if it is
+    an indexed BAM file.
+    """
+    if workers <= 1 or len(filenames) == 1:
+        samples = [load_sam(db, f, sample_group, index=False,
+                            grouping=grouping, workers=workers)
+                   for f in filenames]
+        create_indexes(db)
+        return samples
+
+    # Check all the headers before spending any time on the reads.
+    initialize_subproblems(db)
+    for f in filenames:
+        s = pysam.Samfile(f)
+        insert_or_check_transcripts(db, s.header['SQ'], f)
+        s.close()
+    db.commit()
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        samples = []
+        counted = pool.imap(functools.partial(count_samfile, grouping=grouping),
+                            filenames)
+        for f,(n_reads, leftsites, multiplicities) in \
+                itertools.izip(filenames, counted):
+            instrument.count('reads_parsed', n_reads)
+            sample = insert_sample(db, f, sample_group)
+            with instrument.timer('write_reads'):
+                write_reads_and_multiplicities(db, sample, leftsites,
+                                               multiplicities)
+            db.execute("""update samples set n_reads=? where id=?""",
+                       (n_reads, sample))
+            update_subproblems(db, sample)
+            db.commit()
+            samples.append(sample)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    create_indexes(db)
+    return samples
+
+
+def create_indexes(db):
+    """Create the secondary indexes used when reading *db*, and ANALYZE it.
+
+    The indexes are only created if they don't already exist, so this
+    is cheap to call after every load.  Creating them after the bulk
+    inserts rather than in initialize_database avoids updating them
+    for every row inserted.
+    """
+    with instrument.timer('create_indexes'):
+        _create_indexes(db)
+
+def _create_indexes(db):
+    # Finding subproblems and the self joins in get_sample go from a
+    # multiplicity to its entries, and from a transcript to the
+    # multiplicities it appears in.  Both indexes cover all the
+    # columns those queries read.
+    db.execute("""create index if not exists multiplicity_entries_by_multiplicity
+                  on multiplicity_entries(multiplicity,transcript,position)""")
+    db.execute("""create index if not exists multiplicity_entries_by_transcript
+                  on multiplicity_entries(transcript,multiplicity,position)""")
+    db.execute("""create index if not exists multiplicities_by_sample
+                  on multiplicities(sample,id,n)""")
+    db.execute("""create index if not exists leftsites_by_transcript
+                  on leftsites(sample,transcript,position,n)""")
+    db.commit()
+    db.execute("""analyze""")
+    db.commit()
+
+
+def finalize_database(db):
+    """Index, ANALYZE and VACUUM an already loaded database *db*.
+
+    Use this on databases loaded before load_sam created indexes, or
+    to compact a database once no more samples will be added to it.
+    """
+    create_indexes(db)
+    db.execute("""vacuum""")
+
+
 def split_by_readname(samfile):
     """Return an iterator over the reads in *samfile* grouped by read name.
 
     The SAM file produced by bowtie is sorted by read name.  Often we
     want to work with all of the alignments of a particular read at
     once.  This function turns the flat list of reads into a list of
-    lists of reads, where each sublist has the same read name.
+    lists of reads, where each sublist has the same read name.  Files
+    in other orders can be grouped with group_by_nh or group_by_hash.
     """
     last_read = None
     for r in samfile:
@@ -182,3 +564,204 @@ def split_by_readname(samfile):
         else:
             accum.append(r)
     yield accum    
+
+
+# An alignment as the grouping functions below keep it: only the
+# fields count_reads_and_multiplicities and
+# insert_reads_and_multiplicities read.  rname and pos are -1 for an
+# unmapped read.
+Alignment = collections.namedtuple('Alignment',
+                                   ['qname', 'rname', 'pos', 'is_unmapped'])
+
+def alignment_of(r):
+    """Return the Alignment of the pysam read *r*."""
+    if r.is_unmapped:
+        return Alignment(r.qname, -1, -1, True)
+    else:
+        return Alignment(r.qname, r.rname, r.pos, False)
+
+# The most alignments the grouping functions below hold in memory
+# before spilling to disk, and the number of files they spill to.  A
+# few million alignments take a few hundred megabytes.
+MAX_PENDING_READS = 2000000
+N_PARTITIONS = 64
+
+class SpilledGroups(object):
+    """Group alignments by read name with a bounded amount of memory.
+
+    Alignments are added one at a time with add, in any order, and
+    groups yields the lists of alignments sharing a read name once all
+    have been added.  Until more than *max_reads* alignments have been
+    added, they are kept in a dictionary.  After that every alignment
+    is written to one of *n_partitions* temporary files in *tmpdir*,
+    chosen by a hash of its read name, and groups reads each file back
+    in turn, so no more than about one partition is in memory at once.
+    """
+    def __init__(self, max_reads=MAX_PENDING_READS,
+                 n_partitions=N_PARTITIONS, tmpdir=None):
+        self.max_reads = max_reads
+        self.n_partitions = n_partitions
+        self.tmpdir = tmpdir
+        self.pending = {}
+        self.n_pending = 0
+        self.directory = None
+        self.partitions = None
+    def add(self, a):
+        if self.partitions != None:
+            self._spill(a)
+            return
+        self.pending.setdefault(a.qname, []).append(a)
+        self.n_pending += 1
+        if self.n_pending > self.max_reads:
+            self.directory = tempfile.mkdtemp(prefix="rnaseq-groups-",
+                                              dir=self.tmpdir)
+            self.partitions = [open(os.path.join(self.directory, str(i)), 'w')
+                               for i in range(self.n_partitions)]
+            for group in self.pending.itervalues():
+                for x in group:
+                    self._spill(x)
+            self.pending = {}
+            self.n_pending = 0
+            instrument.count('groups_spilled')
+    def _spill(self, a):
+        f = self.partitions[hash(a.qname) % self.n_partitions]
+        f.write("%s\t%d\t%d\n" % (a.qname, a.rname, a.pos))
+    def groups(self):
+        """Yield each group of alignments, then remove any spilled files."""
+        try:
+            for group in self.pending.itervalues():
+                yield group
+            self.pending = {}
+            if self.partitions == None:
+                return
+            for f in self.partitions:
+                f.close()
+            for i in range(self.n_partitions):
+                groups = {}
+                with open(os.path.join(self.directory, str(i))) as f:
+                    for line in f:
+                        (qname, rname, pos) = line.rstrip('\n').split('\t')
+                        (rname, pos) = (int(rname), int(pos))
+                        groups.setdefault(qname, []).append(
+                            Alignment(qname, rname, pos, rname < 0))
+                for group in groups.itervalues():
+                    yield group
+        finally:
+            self.close()
+    def close(self):
+        """Remove any spilled files."""
+        if self.directory != None:
+            for f in self.partitions:
+                f.close()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+def group_by_hash(samfile, max_reads=MAX_PENDING_READS, tmpdir=None):
+    """Return an iterator over the reads in *samfile* grouped by read name.
+
+    Unlike split_by_readname, *samfile* may be in any order.  Every
+    alignment is collected in a SpilledGroups with at most
+    *max_reads* alignments in memory, so no group is yielded until the
+    whole file has been read.  Each group is a list of Alignments.
+    """
+    spill = SpilledGroups(max_reads, tmpdir=tmpdir)
+    try:
+        for r in samfile:
+            spill.add(alignment_of(r))
+        for group in spill.groups():
+            yield group
+    finally:
+        spill.close()
+
+def number_of_hits(r):
+    """Return the NH tag of the aligned read *r*.
+
+    Raises ValueError if *r* has no NH tag.
+    """
+    try:
+        return r.opt('NH')
+    except KeyError:
+        raise ValueError(("Read %s has no NH tag.  Group files without " + \
+                              "NH tags by name or by hash.") % r.qname)
+
+def group_by_nh(samfile, max_reads=MAX_PENDING_READS, tmpdir=None):
+    """Return an iterator over the reads in *samfile* grouped using NH tags.
+
+    This is for files in any order, such as the coordinate sorted BAM
+    files most aligners write, whose alignments carry an NH tag giving
+    the number of alignments of their read.  Reads with one alignment
+    are yielded as soon as they are read.  The alignments of
+    multireads are held until all NH of them have been seen, and then
+    yielded.  If more than *max_reads* alignments are waiting, the
+    waiting alignments and all further alignments of multireads are
+    spilled to disk as in group_by_hash, and grouped at the end.
+    Groups which never reach NH alignments, as when an aligner reports
+    only some of them, are yielded at the end as they are.  Each group
+    is a list of Alignments.
+
+    Raises ValueError on an aligned read without an NH tag; use
+    group_by_hash for such files.
+    """
+    pending = {}
+    n_pending = 0
+    spill = None
+    try:
+        for r in samfile:
+            a = alignment_of(r)
+            if a.is_unmapped:
+                yield [a]
+                continue
+            nh = number_of_hits(r)
+            if nh <= 1:
+                yield [a]
+            elif spill != None:
+                spill.add(a)
+            else:
+                group = pending.setdefault(a.qname, [])
+                group.append(a)
+                n_pending += 1
+                if len(group) >= nh:
+                    del pending[a.qname]
+                    n_pending -= len(group)
+                    yield group
+                elif n_pending > max_reads:
+                    spill = SpilledGroups(0, tmpdir=tmpdir)
+                    for group in pending.itervalues():
+                        for x in group:
+                            spill.add(x)
+                    pending = {}
+        for group in pending.itervalues():
+            yield group
+        if spill != None:
+            for group in spill.groups():
+                yield group
+    finally:
+        if spill != None:
+            spill.close()
+
+GROUPINGS = ('auto', 'name', 'nh', 'hash')
+
+def group_reads(samfile, grouping='auto', tmpdir=None):
+    """Return an iterator over the reads in *samfile* grouped by read name.
+
+    *grouping* chooses how: 'name' uses split_by_readname, and
+    requires a file grouped by read name, as bowtie writes them; 'nh'
+    uses group_by_nh and 'hash' uses group_by_hash.  'auto' uses 'nh'
+    if the @HD header line of *samfile* says it is sorted by
+    coordinate, and 'name' otherwise.  Spilled files are written to
+    *tmpdir*, by default the system's temporary directory.
+    """
+    if grouping == 'auto':
+        if samfile.header.get('HD', {}).get('SO') == 'coordinate':
+            grouping = 'nh'
+        else:
+            grouping = 'name'
+    if grouping == 'name':
+        return split_by_readname(samfile)
+    elif grouping == 'nh':
+        return group_by_nh(samfile, tmpdir=tmpdir)
+    elif grouping == 'hash':
+        return group_by_hash(samfile, tmpdir=tmpdir)
+    else:
+        raise ValueError("grouping must be one of %s, found %s" % \
+                             (', '.join(GROUPINGS), grouping))
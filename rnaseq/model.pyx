@@ -1,9 +1,15 @@
 
+import itertools
+import os
+import cPickle
 import numpy as np
 cimport numpy as np
+from libc.math cimport exp, log, lgamma, fabs, isfinite, INFINITY
 from pymc import *
 import sqlite3
 from bag import *
+from store import store_path, read_sample
+import instrument
 
 def samples_of_group(db, sample_group):
     """Fetches the samples and numbers of reads in 'sample_group'
@@ -29,19 +35,38 @@ def get_sample(db, sample_id, transcripts):
 
     Returns a dictionary with the transcript IDs as keys, and a
     dictionary with key 'leftsites' referring to a numpy array and
-    'multiplicities' referring to a Bag (see bag.py) of multiplicities
-    as tuples of transcript IDs.
+    'multiplicities' referring to a MultiplicityTable (see bag.py) of
+    the leftsites and other targets of the transcript's multireads.
+    Each multiplicity gives one entry, at its first leftsite on the
+    transcript, counted as many times as it has reads.  Its targets are the transcripts of its other
+    alignments in the order they were written, each repeated once for
+    every alignment on the transcript itself.
+
+    If 'db' has a sample store (see store.py), the leftsites are read
+    from it instead, as views into its memory mapped arrays.
     """
+    path = store_path(db)
+    if path != None:
+        return read_sample(path, sample_id, transcripts)
     r = {}
+    target_sets = TargetSets()
     for t in transcripts:
-        c = db.execute("""select n from leftsites where sample=? 
-                          and transcript=? order by position asc""",
-                       (sample_id, t))
-        leftsites = np.array([x for (x,) in c])
-        if len(leftsites) == 0:
+        q = db.execute("""select length from transcripts where id=?""",
+                       (t,)).fetchone()
+        if q == None:
             raise ValueError("No transcript with ID %d for sample %d in database" % (t,sample_id))
-        multiplicities = Bag()
-        c = db.execute("""select a.multiplicity, a.transcript, b.position 
+        # leftsites only stores nonzero counts, so fill in the rest
+        # of the transcript with zeros.
+        leftsites = np.zeros(q[0]+1, dtype=int)
+        c = db.execute("""select position,n from leftsites where sample=? 
+                          and transcript=?""",
+                       (sample_id, t))
+        for (position,n) in c:
+            leftsites[position] = n
+        positions = []
+        set_ids = []
+        counts = []
+        c = db.execute("""select a.multiplicity, a.transcript, b.position, c.n
                           from multiplicity_entries as a
                           join multiplicity_entries as b
                           on b.transcript = ? and 
@@ -49,15 +74,101 @@ def get_sample(db, sample_id, transcripts):
                           a.multiplicity = b.multiplicity
                           join multiplicities as c
                           on a.multiplicity = c.id
-                          where c.sample = ?""",
+                          where c.sample = ?
+                          order by a.multiplicity, a.id, b.id""",
                        (t,t,sample_id))
         for m in group_by_first(c):
-            pos = m[0][1]
-            targets = tuple([x[0] for x in m])
-            multiplicities.update([(pos,targets)])
-        r[t] = {'leftsites': leftsites, 'multiplicities': multiplicities}
+            positions.append(m[0][1])
+            set_ids.append(target_sets.intern(tuple([x[0] for x in m])))
+            counts.append(m[0][2])
+        r[t] = {'leftsites': leftsites,
+                'multiplicities': MultiplicityTable(target_sets, positions,
+                                                    set_ids, counts)}
     return r
 
+def sql_list(xs):
+    """Format the integers 'xs' as a parenthesized SQL list."""
+    return '(' + ','.join([str(int(x)) for x in xs]) + ')'
+
+def get_samples(db, sample_ids, transcripts):
+    """Fetch leftsites and multiplicities for 'transcripts' in all of 'sample_ids'.
+
+    Returns a dictionary with the sample IDs as keys, each referring
+    to the same structure get_sample returns for that sample.  Unlike
+    calling get_sample on each sample, this issues a fixed number of
+    queries regardless of how many transcripts and samples are asked
+    for.
+    """
+    path = store_path(db)
+    if path != None:
+        return dict([(s, read_sample(path, s, transcripts))
+                     for s in sample_ids])
+    lengths = dict(db.execute("""select id,length from transcripts
+                                 where id in %s""" % sql_list(transcripts)))
+    for t in transcripts:
+        if not(t in lengths):
+            raise ValueError("No transcript with ID %d in database" % t)
+    r = {}
+    for s in sample_ids:
+        r[s] = {}
+        for t in transcripts:
+            r[s][t] = {'leftsites': np.zeros(lengths[t]+1, dtype=int)}
+
+    c = db.execute("""select sample,transcript,position,n from leftsites
+                      where sample in %s and transcript in %s""" % \
+                       (sql_list(sample_ids), sql_list(transcripts)))
+    for (s,t,position,n) in c:
+        r[s][t]['leftsites'][position] = n
+
+    c = db.execute("""select c.sample, b.transcript, a.multiplicity,
+                             a.transcript, b.position, c.n
+                      from multiplicity_entries as b
+                      join multiplicity_entries as a
+                      on a.multiplicity = b.multiplicity and
+                      a.transcript != b.transcript
+                      join multiplicities as c
+                      on a.multiplicity = c.id
+                      where b.transcript in %s and c.sample in %s
+                      order by c.sample, b.transcript, a.multiplicity, a.id, b.id""" % \
+                       (sql_list(transcripts), sql_list(sample_ids)))
+    target_sets = TargetSets()
+    entries = {}
+    for (s,t,mid),m in itertools.groupby(c, lambda x: x[:3]):
+        m = list(m)
+        (positions, set_ids, counts) = entries.setdefault((s,t), ([], [], []))
+        positions.append(m[0][4])
+        set_ids.append(target_sets.intern(tuple([x[3] for x in m])))
+        counts.append(m[0][5])
+    for s in sample_ids:
+        for t in transcripts:
+            (positions, set_ids, counts) = entries.get((s,t), ([], [], []))
+            r[s][t]['multiplicities'] = \
+                MultiplicityTable(target_sets, positions, set_ids, counts)
+    return r
+
+def load_groups(db, groups, transcripts):
+    """Fetch everything needed to model 'transcripts' in any of 'groups'.
+
+    Each sample is read from 'db' once, however many comparisons it
+    is then used in.  Returns a dictionary with keys 'n_transcripts'
+    (the number of transcripts in 'db'), 'n_reads' (a dictionary of
+    group IDs to samples_of_group for that group) and 'samples' (a
+    dictionary of sample IDs to get_sample dictionaries).  Pass it as
+    'loaded' to build_model to avoid reading anything from 'db'.
+    """
+    n_transcripts = db.execute("""select count(id) from transcripts""").fetchone()[0]
+    n_reads = dict([(g, samples_of_group(db, g)) for g in set(groups)])
+    sample_ids = [s for g in n_reads.itervalues() for s in g.iterkeys()]
+    with instrument.timer('get_samples'):
+        samples = get_samples(db, sample_ids, transcripts)
+    return {'n_transcripts': n_transcripts,
+            'n_reads': n_reads,
+            'samples': samples}
+
+def group_samples(loaded, group):
+    """Return the get_sample dictionaries of 'group' in 'loaded' by sample ID."""
+    return dict([(s, loaded['samples'][s]) for s in loaded['n_reads'][group]])
+
 def alpha(float logp):
     """Calculates first parameter of Beta distribution.
 
@@ -76,6 +187,14 @@ def beta(float logp):
     eta = np.exp(4.9 - 0.7*logp) - 1
     return (1 - np.exp(logp))*eta
 
+def alphas_of(logp):
+    """Calculates the first parameter of Beta distributions for an array 'logp'."""
+    return np.exp(logp)*(np.exp(4.9 - 0.7*logp) - 1)
+
+def betas_of(logp):
+    """Calculates the second parameter of Beta distributions for an array 'logp'."""
+    return (1 - np.exp(logp))*(np.exp(4.9 - 0.7*logp) - 1)
+
 def maintain_positive_parameters(minusmu=None, a=None):
     """Guard against feeding negative parameters to Beta distribution.
 
@@ -94,16 +213,45 @@ def maintain_positive_parameters(minusmu=None, a=None):
         return 0
 
 
-def multiplicity_correction(int T, int L, int transcript, dict rs, multiplicities):
-    cdef np.ndarray[np.double_t, ndim=1] pm
-    cdef double thisr, z
-    cdef int position, multiplicity
-    cdef tuple targets
-    thisr = rs[transcript]
+def multiplicity_arrays(multiplicities):
+    """Flatten the MultiplicityTable 'multiplicities' for multiplicity_correction.
+
+    Returns a tuple (keys, positions, counts, set_ids, targets,
+    starts).  'keys' is a list of the transcripts that appear as
+    targets in 'multiplicities'.  Entry i of the table is at leftsite
+    'positions[i]', occurs 'counts[i]' times, and has the target set
+    'set_ids[i]'.  Target set j is the transcripts 'keys[k]' for k in
+    'targets[starts[j]:starts[j+1]]' (or to the end of 'targets' for
+    the last set).  This is done once when the model is built, so
+    multiplicity_correction never has to touch the table.
+    """
+    keys = sorted(set([k for i in np.unique(multiplicities.set_ids)
+                       for k in multiplicities.target_sets[i]]))
+    index = dict([(k,i) for i,k in enumerate(keys)])
+    (set_ids, targets, starts) = multiplicities.set_arrays(index)
+    return (keys, multiplicities.positions, multiplicities.counts,
+            set_ids, targets, starts)
+
+def multiplicity_correction(double T, int L, double thisr,
+                            np.ndarray[np.double_t, ndim=1] rs,
+                            np.ndarray[np.intp_t, ndim=1] positions,
+                            np.ndarray[np.double_t, ndim=1] counts,
+                            np.ndarray[np.intp_t, ndim=1] set_ids,
+                            np.ndarray[np.intp_t, ndim=1] targets,
+                            np.ndarray[np.intp_t, ndim=1] starts):
+    """Calculate the multiread corrected Poisson mean of a transcript.
+
+    'thisr' is the value of r for the transcript, 'rs' the values of
+    r for the keys returned by multiplicity_arrays, and the remaining
+    arrays are as returned by multiplicity_arrays.  The sum of r over
+    each target set is taken once per set, not once per entry.
+    """
+    cdef np.ndarray[np.double_t, ndim=1] pm, z
     pm = (thisr*T/L) * np.ones(L)
-    for (position,targets),multiplicity in multiplicities.itercounts():
-        z = sum(rs[k] for k in targets)
-        pm[position] += multiplicity * z / (z + thisr)
+    if len(positions) > 0:
+        z = np.add.reduceat(rs[targets], starts)[set_ids]
+        pm += np.bincount(positions, weights=counts * z / (z + thisr),
+                          minlength=L)
     return pm
 
 def make_observation(group_id, sample_id, transcript, rs, T, leftsites, multiplicities):
@@ -116,13 +264,24 @@ def make_observation(group_id, sample_id, transcript, rs, T, leftsites, multipli
     observations in 'leftsites'.
     """
     L = len(leftsites)
-    def _pm(rs = None):
-        return multiplicity_correction(T, L, transcript, rs, multiplicities)
+    (keys, positions, counts, set_ids, targets, starts) = \
+        multiplicity_arrays(multiplicities)
+    # Only the r values this transcript's correction depends on are
+    # parents, so the mean is only recomputed when one of them
+    # changes.
+    parents = {'thisr': rs[transcript]}
+    if keys != []:
+        parents['rs'] = [rs[k] for k in keys]
+    def _pm(thisr = None, rs = ()):
+        return multiplicity_correction(T, L, thisr,
+                                       np.array(rs, dtype=float),
+                                       positions, counts, set_ids, targets,
+                                       starts)
     pm_name = 'poisson_mean'+str(transcript)+'-group'+str(group_id)+'-'+str(sample_id)
     poisson_mean = Deterministic(eval=_pm,
                                  doc='Corrected mean for Poisson distribution',
                                  name=pm_name,
-                                 parents={'rs': rs},
+                                 parents=parents,
                                  trace=False, 
                                  verbose=0, 
                                  dtype=float,
@@ -135,16 +294,36 @@ def make_observation(group_id, sample_id, transcript, rs, T, leftsites, multipli
     return [poisson_mean, observation]
 
 
-def build_model(db, group1, group2, transcripts):
-    n_transcripts = db.execute("""select count(id) from transcripts""").fetchone()[0]
-    n_reads = {1: samples_of_group(db, group1),
-               2: samples_of_group(db, group2)}
+def build_model(db, group1, group2, transcripts, method='pymc', loaded=None):
+    """Build an MCMC comparing 'group1' and 'group2' on 'transcripts'.
+
+    'method' chooses how: 'pymc' builds a PyMC model with separate
+    nodes for every transcript, 'vector' builds one with array valued
+    nodes (see build_vector_model; only for small subproblems), and
+    'native' builds a NativeSampler, which doesn't use PyMC at all.
+    All three have a sample method like PyMC's MCMC.sample, and
+    posterior_traces gets the posteriors out of any of them after
+    sampling.
+
+    If 'loaded' is given, it must be the result of load_groups on
+    'transcripts' and groups including 'group1' and 'group2', and the
+    data is taken from it instead of from 'db'.
+    """
+    if loaded == None:
+        loaded = load_groups(db, [group1, group2], transcripts)
+    if method == 'vector':
+        return build_vector_model(db, group1, group2, transcripts, loaded)
+    elif method == 'native':
+        return build_native_sampler(db, group1, group2, transcripts, loaded)
+    elif method != 'pymc':
+        raise ValueError("Unknown method %s for build_model" % method)
+    n_transcripts = loaded['n_transcripts']
+    n_reads = {1: loaded['n_reads'][group1],
+               2: loaded['n_reads'][group2]}
     samples1 = n_reads[1].keys()
     samples2 = n_reads[2].keys()
-    data = {1: dict([(s,get_sample(db, s, transcripts))
-                     for s in n_reads[1].keys()]),
-            2: dict([(s,get_sample(db, s, transcripts))
-                     for s in n_reads[2].keys()])}
+    data = {1: group_samples(loaded, group1),
+            2: group_samples(loaded, group2)}
     [a,minusmu,maintain_beta,alphas,betas,r,d] = [{},{},{},{},{},{},{}]
     for t in transcripts:
         # t gets reassigned at each iteration, not redefined, so it
@@ -267,4 +446,933 @@ def build_model(db, group1, group2, transcripts):
     return MCMC([minusmu, a, maintain_beta, alphas, betas, r, d])
 
 
+def sample_arrays(sample, transcripts):
+    """Lay out one sample's data for vector_multiplicity_correction.
+
+    'sample' is a dictionary as returned by get_sample.  The leftsites
+    of 'transcripts' are concatenated in order, and the multiplicities
+    of all of them are flattened together as by multiplicity_arrays,
+    with positions offset into the concatenated leftsites and targets
+    given as indices into 'transcripts'.  Returns a tuple (leftsites,
+    lengths, owners, positions, counts, targets, starts), where
+    'owners[i]' is the index of the transcript entry i belongs to.
+    """
+    index = dict([(t,i) for i,t in enumerate(transcripts)])
+    leftsites = np.concatenate([sample[t]['leftsites'] for t in transcripts])
+    lengths = np.array([len(sample[t]['leftsites']) for t in transcripts],
+                       dtype=np.intp)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    owners = []
+    positions = []
+    counts = []
+    targets = []
+    starts = []
+    for i,t in enumerate(transcripts):
+        for (position,ts),multiplicity in \
+                sample[t]['multiplicities'].itercounts():
+            owners.append(i)
+            positions.append(offsets[i] + position)
+            counts.append(multiplicity)
+            starts.append(len(targets))
+            targets.extend([index[k] for k in ts])
+    return (leftsites, lengths,
+            np.array(owners, dtype=np.intp),
+            np.array(positions, dtype=np.intp),
+            np.array(counts, dtype=float),
+            np.array(targets, dtype=np.intp),
+            np.array(starts, dtype=np.intp))
+
+def vector_multiplicity_correction(double T,
+                                   np.ndarray[np.double_t, ndim=1] rs,
+                                   np.ndarray[np.intp_t, ndim=1] lengths,
+                                   np.ndarray[np.intp_t, ndim=1] owners,
+                                   np.ndarray[np.intp_t, ndim=1] positions,
+                                   np.ndarray[np.double_t, ndim=1] counts,
+                                   np.ndarray[np.intp_t, ndim=1] targets,
+                                   np.ndarray[np.intp_t, ndim=1] starts):
+    """Calculate the multiread corrected Poisson means of a whole sample.
+
+    'rs' holds r for each transcript, and the other arrays are as
+    returned by sample_arrays.  Returns the means of the concatenated
+    leftsites, the same as concatenating multiplicity_correction for
+    each transcript.
+    """
+    cdef np.ndarray[np.double_t, ndim=1] pm, z
+    pm = np.repeat(rs*T/lengths, lengths)
+    if len(positions) > 0:
+        z = np.add.reduceat(rs[targets], starts)
+        pm += np.bincount(positions, weights=counts * z / (z + rs[owners]),
+                          minlength=len(pm))
+    return pm
+
+def build_vector_model(db, group1, group2, transcripts, loaded=None):
+    """Build the model of build_model with array valued variables.
+
+    Instead of separate nodes for every transcript and every (sample,
+    transcript) pair, minusmu and a are each one array valued
+    stochastic over 'transcripts', and each sample has one array of r,
+    one corrected Poisson mean and one Poisson observation covering
+    all of 'transcripts'.  The joint distribution is the same as
+    build_model's, but the model has a handful of nodes per sample
+    instead of five per transcript per sample.  Element i of each
+    array belongs to transcripts[i].  'loaded' is as for build_model.
+
+    PyMC proposes a new value for a whole array stochastic at once, so
+    minusmu and a together, and the r of each sample, are each given
+    an AdaptiveMetropolis step method, which learns the covariance of
+    its proposals during burn in.  Even so, a joint proposal over
+    every transcript is accepted less and less often as the
+    subproblem grows, and the usual 2000 sweeps of burn in are only
+    enough for subproblems of a few dozen transcripts.  Use the
+    'native' method, which updates one parameter at a time, for
+    anything larger.
+    """
+    if loaded == None:
+        loaded = load_groups(db, [group1, group2], transcripts)
+    n_transcripts = loaded['n_transcripts']
+    n_reads = {1: loaded['n_reads'][group1],
+               2: loaded['n_reads'][group2]}
+    data = {1: group_samples(loaded, group1),
+            2: group_samples(loaded, group2)}
+    N = len(transcripts)
+    gamma_alpha = 5230.0/np.sqrt(n_transcripts)
+    gamma_beta = 1/(2.1e-3 * np.sqrt(n_transcripts))
+    minusmu = Gamma('minusmu', alpha=gamma_alpha, beta=gamma_beta,
+                    value=(gamma_alpha/gamma_beta)*np.ones(N))
+    a = Cauchy('a', 0, 29, value=np.zeros(N))
+
+    def _maintain(minusmu=None, a=None):
+        for cov in [0.5, -0.5]:
+            logp = -1*minusmu + cov*a
+            if np.any(alphas_of(logp) <= 0) or np.any(betas_of(logp) <= 0):
+                return -np.inf
+        return 0
+    maintain_beta = Potential(logp = _maintain,
+                              name = 'maintain_beta',
+                              parents = {'minusmu': minusmu, 'a': a},
+                              doc = 'Maintain beta parameters positive',
+                              verbose = 0,
+                              cache_depth = 2)
+
+    def make_alphas(cov):
+        def _f(minusmu=None, a=None):
+            return alphas_of(-1*minusmu + cov*a)
+        return _f
+
+    def make_betas(cov):
+        def _f(minusmu=None, a=None):
+            return betas_of(-1*minusmu + cov*a)
+        return _f
+
+    def make_mean(T, arrays):
+        def _pm(rs=None):
+            return vector_multiplicity_correction(T, rs, *arrays)
+        return _pm
+
+    # All group 1 samples use a covariate of 0.5, all group 2
+    # samples a covariate of -0.5.
+    nodes = [minusmu, a, maintain_beta]
+    for g,cov in [(1,0.5), (2,-0.5)]:
+        alphas = Deterministic(eval=make_alphas(cov),
+                               doc='',
+                               name='alphas-group'+str(g),
+                               parents={'minusmu':minusmu, 'a':a},
+                               trace=False,
+                               verbose=0,
+                               dtype=float,
+                               plot=False,
+                               cache_depth=2)
+        betas = Deterministic(eval=make_betas(cov),
+                              doc='',
+                              name='betas-group'+str(g),
+                              parents={'minusmu':minusmu, 'a':a},
+                              trace=False,
+                              verbose=0,
+                              dtype=float,
+                              plot=False,
+                              cache_depth=2)
+        nodes.extend([alphas, betas])
+        for s,T in n_reads[g].iteritems():
+            arrays = sample_arrays(data[g][s], transcripts)
+            r = Beta('r-group'+str(g)+'-'+str(s),
+                     alpha=alphas, beta=betas, trace=True)
+            poisson_mean = Deterministic(eval=make_mean(T, arrays[1:]),
+                                         doc='Corrected means for Poisson distribution',
+                                         name='poisson_mean-group'+str(g)+'-'+str(s),
+                                         parents={'rs': r},
+                                         trace=False,
+                                         verbose=0,
+                                         dtype=float,
+                                         plot=False,
+                                         cache_depth=2)
+            observation = Poisson('d-group'+str(g)+'-'+str(s),
+                                  mu=poisson_mean,
+                                  observed=True, value=arrays[0])
+            nodes.extend([r, poisson_mean, observation])
+    M = MCMC(nodes)
+    M.use_step_method(AdaptiveMetropolis, [minusmu, a])
+    for node in nodes:
+        if isinstance(node, Beta):
+            M.use_step_method(AdaptiveMetropolis, node)
+    M.vectorized = True
+    return M
+
+def posterior_traces(M, transcripts):
+    """Fetch the traces of minusmu and a from 'M' after sampling.
+
+    'M' is a model returned by build_model, by any method.  Returns a
+    dictionary with the transcript IDs as keys, each referring to a
+    dictionary with keys 'minusmu' and 'a' and numpy arrays of the
+    traces as values.
+    """
+    r = {}
+    if isinstance(M, NativeSampler):
+        return M.traces()
+    elif getattr(M, 'vectorized', False):
+        minusmu = M.trace('minusmu')[:]
+        a = M.trace('a')[:]
+        for i,t in enumerate(transcripts):
+            r[t] = {'minusmu': minusmu[:,i], 'a': a[:,i]}
+    else:
+        for t in transcripts:
+            r[t] = {'minusmu': M.trace('minusmu'+str(t))[:],
+                    'a': M.trace('a'+str(t))[:]}
+    return r
+
+
+cdef struct Layout:
+    # The data of a subproblem flattened for NativeSampler.  A unit
+    # is one (sample, transcript) pair, numbered s*N + t.
+    int N, S
+    double *T           # [S] number of reads in each sample
+    double *cov         # [S] covariate of each sample
+    double *L           # [N] number of leftsites of each transcript
+    double *drest       # [S*N] reads at leftsites with no multireads
+    np.intp_t *sstart   # [S*N+1] range of each unit in slots
+    double *dslot       # reads at each leftsite with multireads
+    double *corr        # scratch space of the same size as dslot
+    np.intp_t *estart   # [S*N+1] range of each unit in entries
+    np.intp_t *eslot    # the slot each multiplicity entry adds to
+    double *ecount      # the count of each multiplicity entry
+    np.intp_t *tstart   # range of each entry in ttarget
+    np.intp_t *ttarget  # target transcripts of multiplicity entries
+    np.intp_t *dstart   # [S*N+1] range of each unit in dep
+    np.intp_t *dep      # transcripts whose means depend on each unit
+
+cdef inline double beta_logp(double r, double logp):
+    """Log density of r under the Beta prior with mean exp(logp)."""
+    cdef double eta, al, be
+    eta = exp(4.9 - 0.7*logp) - 1
+    al = exp(logp)*eta
+    be = (1 - exp(logp))*eta
+    if al <= 0 or be <= 0:
+        return -INFINITY
+    return lgamma(al+be) - lgamma(al) - lgamma(be) + \
+        (al-1)*log(r) + (be-1)*log(1-r)
+
+cdef double transcript_prior(Layout *d, double *r, int t, double minusmu,
+                             double a, double gamma_alpha, double gamma_beta):
+    """Log density of everything in the model touching minusmu and a of t."""
+    cdef int s
+    cdef double lp
+    if minusmu <= 0:
+        return -INFINITY
+    # The potential in build_model, maintain_positive_parameters.
+    if beta_logp(0.5, -minusmu + 0.5*a) == -INFINITY or \
+            beta_logp(0.5, -minusmu - 0.5*a) == -INFINITY:
+        return -INFINITY
+    lp = (gamma_alpha-1)*log(minusmu) - gamma_beta*minusmu - \
+        log(1 + (a/29.0)*(a/29.0))
+    for s in range(d.S):
+        lp += beta_logp(r[s*d.N+t], -minusmu + d.cov[s]*a)
+    return lp
+
+cdef double transcript_loglik(Layout *d, double *r, int s, int t):
+    """Poisson log likelihood of the leftsites of t in sample s.
+
+    Constant terms are dropped.  Leftsites without multireads all
+    have the same mean, so only the leftsites with multireads are
+    visited one by one.
+    """
+    cdef int u = s*d.N + t
+    cdef np.intp_t e, k, slot
+    cdef double rt, b, z, c, total, ll
+    rt = r[u]
+    b = rt*d.T[s]/d.L[t]
+    for slot in range(d.sstart[u], d.sstart[u+1]):
+        d.corr[slot] = 0
+    total = 0
+    for e in range(d.estart[u], d.estart[u+1]):
+        z = 0
+        for k in range(d.tstart[e], d.tstart[e+1]):
+            z += r[s*d.N + d.ttarget[k]]
+        c = d.ecount[e]*z/(z + rt)
+        d.corr[d.eslot[e]] += c
+        total += c
+    ll = d.drest[u]*log(b) - rt*d.T[s] - total
+    for slot in range(d.sstart[u], d.sstart[u+1]):
+        ll += d.dslot[slot]*log(b + d.corr[slot])
+    return ll
+
+cdef double dependent_loglik(Layout *d, double *r, int s, int t):
+    """Log likelihood of every transcript of sample s whose mean uses r of t."""
+    cdef int u = s*d.N + t
+    cdef np.intp_t k
+    cdef double ll = 0
+    for k in range(d.dstart[u], d.dstart[u+1]):
+        ll += transcript_loglik(d, r, s, d.dep[k])
+    return ll
+
+cdef class NativeSampler:
+    """Adaptive Metropolis-within-Gibbs sampler for the one way model.
 
+    This samples the same posterior as build_model without going
+    through PyMC.  Each sweep updates minusmu and a of every
+    transcript, then r of every transcript in every sample, one at a
+    time, by random walk Metropolis (r on the logit scale).  During
+    burn in, the step size of each parameter is tuned every 50
+    sweeps towards an acceptance rate of 0.44.
+
+    Create one with build_native_sampler.  The interface mimics the
+    parts of PyMC's MCMC used here: call sample(iter, burn, thin),
+    then get the traces with posterior_traces.
+    """
+    cdef Layout d
+    cdef object arrays
+    cdef public object transcripts
+    cdef public object minusmu, a, r, log_sd, accepted
+    cdef public int n_sweeps
+    cdef public double gamma_alpha, gamma_beta
+    cdef public object minusmu_trace, a_trace
+
+    def __init__(self, data, n_reads, covariates, transcripts, n_transcripts,
+                 seed=None):
+        """'data' maps sample IDs to get_sample dictionaries, 'n_reads'
+        and 'covariates' map the same IDs to the number of reads and
+        the covariate of each sample.
+        """
+        if seed != None:
+            np.random.seed(seed)
+        samples = sorted(data.keys())
+        N = len(transcripts)
+        S = len(samples)
+        index = dict([(t,i) for i,t in enumerate(transcripts)])
+        L = np.array([len(data[samples[0]][t]['leftsites'])
+                      for t in transcripts], dtype=float)
+        drest = np.zeros(S*N)
+        sstart = [0]
+        dslot = []
+        estart = [0]
+        eslot = []
+        ecount = []
+        tstart = [0]
+        ttarget = []
+        dstart = [0]
+        dep = []
+        r = np.zeros(S*N)
+        for s,sample in enumerate(samples):
+            dependents = [set([i]) for i in range(N)]
+            for i,t in enumerate(transcripts):
+                leftsites = data[sample][t]['leftsites']
+                r[s*N+i] = (np.sum(leftsites) + 0.5) / (n_reads[sample] + 1.0)
+                slots = {}
+                for (position,ts),multiplicity in \
+                        data[sample][t]['multiplicities'].itercounts():
+                    if not(position in slots):
+                        slots[position] = len(dslot)
+                        dslot.append(leftsites[position])
+                    eslot.append(slots[position])
+                    ecount.append(multiplicity)
+                    ttarget.extend([index[k] for k in ts])
+                    tstart.append(len(ttarget))
+                    for k in ts:
+                        dependents[index[k]].add(i)
+                drest[s*N+i] = np.sum(leftsites) - \
+                    sum([leftsites[p] for p in slots.iterkeys()])
+                sstart.append(len(dslot))
+                estart.append(len(eslot))
+            for i in range(N):
+                dep.extend(sorted(dependents[i]))
+                dstart.append(len(dep))
+
+        intp = lambda xs: np.ascontiguousarray(xs, dtype=np.intp)
+        dbl = lambda xs: np.ascontiguousarray(xs, dtype=np.double)
+        self.arrays = {'T': dbl([n_reads[s] for s in samples]),
+                       'cov': dbl([covariates[s] for s in samples]),
+                       'L': dbl(L), 'drest': dbl(drest),
+                       'sstart': intp(sstart), 'dslot': dbl(dslot),
+                       'corr': np.zeros(max(len(dslot),1)),
+                       'estart': intp(estart), 'eslot': intp(eslot),
+                       'ecount': dbl(ecount), 'tstart': intp(tstart),
+                       'ttarget': intp(ttarget), 'dstart': intp(dstart),
+                       'dep': intp(dep)}
+        self.d.N = N
+        self.d.S = S
+        self._bind()
+
+        self.transcripts = list(transcripts)
+        self.gamma_alpha = 5230.0/np.sqrt(n_transcripts)
+        self.gamma_beta = 1/(2.1e-3 * np.sqrt(n_transcripts))
+        self.r = np.clip(r, 1e-12, 1 - 1e-12)
+        # Start minusmu where the data puts the transcripts, as long
+        # as that keeps it positive.
+        self.minusmu = np.maximum(-np.mean(np.log(self.r.reshape((S,N))),
+                                           axis=0), 0.1)
+        self.a = np.zeros(N)
+        # One step size per parameter: minusmu and a of each
+        # transcript, then r of each unit.
+        self.log_sd = np.log(0.1)*np.ones(2*N + S*N)
+        self.accepted = np.zeros(2*N + S*N, dtype=np.intp)
+        self.n_sweeps = 0
+        self.minusmu_trace = []
+        self.a_trace = []
+
+    cdef _bind(self):
+        """Point the Layout at the arrays in self.arrays."""
+        cdef np.ndarray x
+        x = self.arrays['T']; self.d.T = <double*>x.data
+        x = self.arrays['cov']; self.d.cov = <double*>x.data
+        x = self.arrays['L']; self.d.L = <double*>x.data
+        x = self.arrays['drest']; self.d.drest = <double*>x.data
+        x = self.arrays['sstart']; self.d.sstart = <np.intp_t*>x.data
+        x = self.arrays['dslot']; self.d.dslot = <double*>x.data
+        x = self.arrays['corr']; self.d.corr = <double*>x.data
+        x = self.arrays['estart']; self.d.estart = <np.intp_t*>x.data
+        x = self.arrays['eslot']; self.d.eslot = <np.intp_t*>x.data
+        x = self.arrays['ecount']; self.d.ecount = <double*>x.data
+        x = self.arrays['tstart']; self.d.tstart = <np.intp_t*>x.data
+        x = self.arrays['ttarget']; self.d.ttarget = <np.intp_t*>x.data
+        x = self.arrays['dstart']; self.d.dstart = <np.intp_t*>x.data
+        x = self.arrays['dep']; self.d.dep = <np.intp_t*>x.data
+
+    def __reduce__(self):
+        state = {'N': self.d.N, 'S': self.d.S, 'arrays': self.arrays,
+                 'transcripts': self.transcripts,
+                 'gamma_alpha': self.gamma_alpha,
+                 'gamma_beta': self.gamma_beta,
+                 'minusmu': self.minusmu, 'a': self.a, 'r': self.r,
+                 'log_sd': self.log_sd, 'accepted': self.accepted,
+                 'n_sweeps': self.n_sweeps,
+                 'minusmu_trace': self.minusmu_trace,
+                 'a_trace': self.a_trace}
+        return (_restore_native_sampler, (state,))
+
+    def _restore(self, state):
+        self.d.N = state['N']
+        self.d.S = state['S']
+        self.arrays = state['arrays']
+        self._bind()
+        for k in ['transcripts', 'gamma_alpha', 'gamma_beta', 'minusmu',
+                  'a', 'r', 'log_sd', 'accepted', 'n_sweeps',
+                  'minusmu_trace', 'a_trace']:
+            setattr(self, k, state[k])
+
+    def sweep(self, int n, bint adapt):
+        """Run 'n' sweeps, tuning step sizes if 'adapt' is True."""
+        cdef np.ndarray[np.double_t, ndim=1] minusmu = self.minusmu
+        cdef np.ndarray[np.double_t, ndim=1] a = self.a
+        cdef np.ndarray[np.double_t, ndim=1] r = self.r
+        cdef np.ndarray[np.double_t, ndim=1] log_sd = self.log_sd
+        cdef np.ndarray[np.intp_t, ndim=1] accepted = self.accepted
+        cdef np.ndarray[np.double_t, ndim=1] normals, uniforms
+        cdef double *rp = <double*>r.data
+        cdef int N = self.d.N, S = self.d.S, P = 2*N + S*N
+        cdef int i, t, s, u, j
+        cdef double cur, prop, old, new, x, delta
+        for i in range(n):
+            normals = np.random.standard_normal(P)
+            uniforms = np.log(np.random.random_sample(P))
+            for t in range(N):
+                cur = transcript_prior(&self.d, rp, t, minusmu[t], a[t],
+                                       self.gamma_alpha, self.gamma_beta)
+                old = minusmu[t]
+                new = old + exp(log_sd[t])*normals[t]
+                prop = transcript_prior(&self.d, rp, t, new, a[t],
+                                        self.gamma_alpha, self.gamma_beta)
+                if uniforms[t] < prop - cur:
+                    minusmu[t] = new
+                    cur = prop
+                    accepted[t] += 1
+                old = a[t]
+                new = old + exp(log_sd[N+t])*normals[N+t]
+                prop = transcript_prior(&self.d, rp, t, minusmu[t], new,
+                                        self.gamma_alpha, self.gamma_beta)
+                if uniforms[N+t] < prop - cur:
+                    a[t] = new
+                    accepted[N+t] += 1
+            for s in range(S):
+                for t in range(N):
+                    u = s*N + t
+                    j = 2*N + u
+                    x = -minusmu[t] + self.d.cov[s]*a[t]
+                    old = r[u]
+                    cur = beta_logp(old, x) + dependent_loglik(&self.d, rp, s, t) + \
+                        log(old) + log(1-old)
+                    new = 1/(1 + exp(-(log(old/(1-old)) + exp(log_sd[j])*normals[j])))
+                    if new <= 0 or new >= 1:
+                        continue
+                    r[u] = new
+                    prop = beta_logp(new, x) + dependent_loglik(&self.d, rp, s, t) + \
+                        log(new) + log(1-new)
+                    if uniforms[j] < prop - cur:
+                        accepted[j] += 1
+                    else:
+                        r[u] = old
+            self.n_sweeps += 1
+            if adapt and self.n_sweeps % 50 == 0:
+                delta = min(0.01, 1/np.sqrt(self.n_sweeps/50))
+                for j in range(P):
+                    if accepted[j] > 0.44*50:
+                        log_sd[j] += delta
+                    else:
+                        log_sd[j] -= delta
+                    accepted[j] = 0
+
+    def sample(self, iter, burn=0, thin=1):
+        """Run 'iter' sweeps, keeping every 'thin'th after the first 'burn'.
+
+        Step sizes are tuned during the 'burn' sweeps.  Calling sample
+        again continues from where the last call stopped, and adds to
+        the same traces.
+        """
+        self.sweep(burn, True)
+        for i in range(iter - burn):
+            self.sweep(1, False)
+            if (i+1) % thin == 0:
+                self.minusmu_trace.append(self.minusmu.copy())
+                self.a_trace.append(self.a.copy())
+
+    def traces(self):
+        """Return the traces as posterior_traces does."""
+        minusmu = np.array(self.minusmu_trace).reshape((-1, self.d.N))
+        a = np.array(self.a_trace).reshape((-1, self.d.N))
+        return dict([(t, {'minusmu': minusmu[:,i], 'a': a[:,i]})
+                     for i,t in enumerate(self.transcripts)])
+
+    def overdisperse(self, double scale=1.0, rng=np.random):
+        """Move the starting point of the chain by a random step.
+
+        Every build of the same data starts from the same point, so
+        chains meant to be compared by R-hat must first be moved
+        apart.  a and the logit of r each take a normal step with
+        standard deviation 'scale', and minusmu a step of a tenth of
+        'scale' on the log scale, since it is known far more tightly.
+        a is then pulled back inside the range where the Beta
+        distribution of r stays proper.  'rng' is a numpy RandomState,
+        or numpy.random itself.
+        """
+        cdef int N = self.d.N
+        self.minusmu *= np.exp(rng.normal(0, 0.1*scale, N))
+        self.a += rng.normal(0, scale, N)
+        self.a[:] = np.clip(self.a, -2*(self.minusmu - 1e-3),
+                            2*(self.minusmu - 1e-3))
+        logit = np.log(self.r/(1 - self.r)) + rng.normal(0, scale, len(self.r))
+        self.r[:] = np.clip(1/(1 + np.exp(-logit)), 1e-12, 1 - 1e-12)
+
+    cdef double prior_at(self, int t, double minusmu, double a):
+        cdef np.ndarray[np.double_t, ndim=1] r = self.r
+        return transcript_prior(&self.d, <double*>r.data, t, minusmu, a,
+                                self.gamma_alpha, self.gamma_beta)
+
+    cdef double get_param(self, int j):
+        """Parameter 'j', numbered as in sweep, on its working scale.
+
+        minusmu is worked on the log scale, r on the logit scale, and a
+        as it is, so no parameter ever leaves its range.
+        """
+        cdef int N = self.d.N
+        if j < N:
+            return log(self.minusmu[j])
+        elif j < 2*N:
+            return self.a[j-N]
+        else:
+            return log(self.r[j-2*N]/(1 - self.r[j-2*N]))
+
+    cdef double set_param(self, int j, double x):
+        """Set parameter 'j' to 'x' on its working scale.
+
+        Returns the log density of everything in the model touching
+        the parameter.
+        """
+        cdef int N = self.d.N, s, t
+        cdef np.ndarray[np.double_t, ndim=1] minusmu = self.minusmu
+        cdef np.ndarray[np.double_t, ndim=1] a = self.a
+        cdef np.ndarray[np.double_t, ndim=1] r = self.r
+        if j < N:
+            minusmu[j] = exp(x)
+            return self.prior_at(j, minusmu[j], a[j])
+        elif j < 2*N:
+            a[j-N] = x
+            return self.prior_at(j-N, minusmu[j-N], x)
+        s = (j - 2*N) // N
+        t = (j - 2*N) % N
+        r[j-2*N] = 1/(1 + exp(-x))
+        if r[j-2*N] <= 0 or r[j-2*N] >= 1:
+            return -INFINITY
+        return beta_logp(r[j-2*N], -minusmu[t] + self.d.cov[s]*a[t]) + \
+            dependent_loglik(&self.d, <double*>r.data, s, t)
+
+    cdef double line_max(self, int j):
+        """Move parameter 'j' uphill, and return how far it moved.
+
+        Takes one Newton step on finite differences, or a unit step
+        along the gradient where the density isn't concave, and halves
+        it until the density increases.  If it never does, the
+        parameter stays where it was.
+        """
+        cdef double h = 1e-4, x, f0, fp, fm, g, H, step
+        cdef int k
+        x = self.get_param(j)
+        f0 = self.set_param(j, x)
+        fp = self.set_param(j, x + h)
+        fm = self.set_param(j, x - h)
+        g = (fp - fm)/(2*h)
+        H = (fp - 2*f0 + fm)/(h*h)
+        if not(isfinite(g)) or not(isfinite(H)):
+            step = h if fp > f0 else (-h if fm > f0 else 0)
+        elif H < 0:
+            step = -g/H
+        else:
+            step = 1 if g > 0 else -1
+        step = max(-2, min(2, step))
+        for k in range(40):
+            if step != 0 and self.set_param(j, x + step) > f0:
+                return fabs(step)
+            step /= 2
+        self.set_param(j, x)
+        return 0
+
+    def maximize(self, int max_iter=1000, double tol=1e-6):
+        """Move every parameter to the posterior mode.
+
+        Coordinate ascent over the same parameters sweep updates, in
+        the same order.  Each update of r of a unit reallocates the
+        multireads it shares with other transcripts, as the E step of
+        an EM algorithm would, before moving r.  Stops once no
+        parameter moves more than 'tol' on its working scale in a
+        pass, or after 'max_iter' passes.  Returns the number of
+        passes.  The traces are not touched.
+        """
+        cdef int P = 2*self.d.N + self.d.S*self.d.N, i, j
+        cdef double biggest
+        for i in range(max_iter):
+            biggest = 0
+            for j in range(P):
+                biggest = max(biggest, self.line_max(j))
+            if biggest < tol:
+                return i+1
+        return max_iter
+
+    def laplace(self):
+        """Laplace approximation of minusmu and a of each transcript.
+
+        Call after maximize.  Returns a pair (mode, covariance): an N
+        by 2 array of minusmu and a of each transcript at the mode,
+        and an N by 2 by 2 array of the inverse of the negative Hessian
+        of the log density in them, with r held at its mode.  Where
+        the Hessian isn't negative definite, only its diagonal is
+        used, and a flat direction gets a variance of 1e6.
+        """
+        cdef int t, N = self.d.N
+        cdef double m, x, f0, h = 1e-4
+        mode = np.zeros((N,2))
+        covariance = np.zeros((N,2,2))
+        for t in range(N):
+            m = self.minusmu[t]
+            x = self.a[t]
+            f0 = self.prior_at(t, m, x)
+            H = np.zeros((2,2))
+            H[0,0] = (self.prior_at(t, m+h, x) - 2*f0 +
+                      self.prior_at(t, m-h, x))/(h*h)
+            H[1,1] = (self.prior_at(t, m, x+h) - 2*f0 +
+                      self.prior_at(t, m, x-h))/(h*h)
+            H[0,1] = H[1,0] = (self.prior_at(t, m+h, x+h) -
+                               self.prior_at(t, m+h, x-h) -
+                               self.prior_at(t, m-h, x+h) +
+                               self.prior_at(t, m-h, x-h))/(4*h*h)
+            mode[t] = (m, x)
+            if np.all(np.isfinite(H)) and H[0,0] < 0 and \
+                    H[0,0]*H[1,1] - H[0,1]*H[1,0] > 0:
+                covariance[t] = np.linalg.inv(-H)
+            else:
+                d = -np.diag(H)
+                d[~(np.isfinite(d) & (d > 1e-6))] = 1e-6
+                covariance[t] = np.diag(1/d)
+        return (mode, covariance)
+
+def laplace_traces(M, n_samples=500):
+    """Draw 'n_samples' samples from the Laplace approximation of 'M'.
+
+    'M' is a NativeSampler after maximize.  Returns traces as
+    posterior_traces does, so the approximation can be stored and
+    summarized exactly as the posteriors from sampling are.
+    """
+    (mode, covariance) = M.laplace()
+    z = np.random.standard_normal((n_samples, 2))
+    traces = {}
+    for i,t in enumerate(M.transcripts):
+        draws = mode[i] + np.dot(z, np.linalg.cholesky(covariance[i]).T)
+        traces[t] = {'minusmu': draws[:,0], 'a': draws[:,1]}
+    return traces
+
+def _restore_native_sampler(state):
+    M = NativeSampler.__new__(NativeSampler)
+    M._restore(state)
+    return M
+
+def save_checkpoint(M, filename):
+    """Pickle the NativeSampler 'M' to 'filename'.
+
+    The state of numpy's random number generator is saved with it, so
+    a chain continued with load_checkpoint is the same chain that
+    would have run without stopping.  The file is written under
+    another name and renamed, so 'filename' always holds a complete
+    checkpoint, even if the process is killed while writing it.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        cPickle.dump((M, np.random.get_state()), f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
+
+def load_checkpoint(filename):
+    """Return the NativeSampler saved in 'filename' by save_checkpoint."""
+    with open(filename, 'rb') as f:
+        (M, random_state) = cPickle.load(f)
+    np.random.set_state(random_state)
+    return M
+
+def sample_checkpointed(M, iter, burn, thin, filename, every=1000):
+    """Run M.sample(iter, burn, thin), saving 'M' to 'filename' as it goes.
+
+    'M' is a NativeSampler, either new or from load_checkpoint, in
+    which case sampling picks up where the checkpoint left off.  It
+    is saved with save_checkpoint after every 'every' sweeps (rounded
+    down to a multiple of 'thin').
+    """
+    every = max(thin, every - every % thin)
+    while M.n_sweeps < iter:
+        if M.n_sweeps < burn:
+            M.sweep(min(every, burn - M.n_sweeps), True)
+        else:
+            M.sample(min(every, iter - M.n_sweeps), thin=thin)
+        save_checkpoint(M, filename)
+
+def build_native_sampler(db, group1, group2, transcripts, loaded=None,
+                         seed=None):
+    """Build a NativeSampler comparing 'group1' and 'group2' on 'transcripts'.
+
+    'loaded' is as for build_model.
+    """
+    if loaded == None:
+        loaded = load_groups(db, [group1, group2], transcripts)
+    n_reads = {}
+    covariates = {}
+    data = {}
+    # All group 1 samples use a covariate of 0.5, all group 2
+    # samples a covariate of -0.5.
+    for g,cov in [(group1,0.5), (group2,-0.5)]:
+        samples = loaded['n_reads'][g]
+        n_reads.update(samples)
+        covariates.update(dict([(s,cov) for s in samples]))
+        data.update(group_samples(loaded, g))
+    return NativeSampler(data, n_reads, covariates, transcripts,
+                         loaded['n_transcripts'], seed=seed)
+
+def sample_posterior(db, group1, group2, transcripts, n_samples=500,
+                     method='pymc', loaded=None, checkpoint=None):
+    """Sample the posterior of 'transcripts' comparing 'group1' and 'group2'.
+
+    Builds a model with build_model by 'method', draws 'n_samples'
+    samples from it after 2000 iterations of burn in, thinning by 5,
+    and returns the traces as posterior_traces does.  'loaded' is as
+    for build_model.
+
+    If 'checkpoint' is given, the chain is saved to that file as it
+    runs (see sample_checkpointed), and if the file already exists,
+    the chain is continued from it instead of starting over.  Only
+    the 'native' method can be checkpointed.  The file is left in
+    place afterwards; remove it once the posteriors are safely stored.
+
+    With 'method' set to 'map', there is no sampling.  A
+    NativeSampler is moved to the posterior mode with its maximize
+    method, and 'n_samples' draws from the Laplace approximation at
+    the mode are returned instead (see laplace_traces).
+    """
+    if method == 'map' and checkpoint == None:
+        with instrument.timer('build_model'):
+            M = build_model(db, group1, group2, transcripts, method='native',
+                            loaded=loaded)
+        count_nodes(M)
+        with instrument.timer('maximize'):
+            M.maximize()
+        return laplace_traces(M, n_samples)
+    if checkpoint == None:
+        with instrument.timer('build_model'):
+            M = build_model(db, group1, group2, transcripts, method=method,
+                            loaded=loaded)
+        count_nodes(M)
+        with instrument.timer('sample'):
+            M.sample(n_samples*5 + 2000, burn=2000, thin=5)
+        instrument.count('mcmc_iterations', n_samples*5 + 2000)
+        return posterior_traces(M, transcripts)
+    if method != 'native':
+        raise ValueError("Only the native method can be checkpointed, not %s" % method)
+    if os.path.exists(checkpoint):
+        M = load_checkpoint(checkpoint)
+        if M.transcripts != list(transcripts):
+            raise ValueError("Checkpoint %s is of transcripts %s, not %s" % \
+                                 (checkpoint, M.transcripts, list(transcripts)))
+    else:
+        with instrument.timer('build_model'):
+            M = build_model(db, group1, group2, transcripts, method=method,
+                            loaded=loaded)
+        count_nodes(M)
+    done = M.n_sweeps
+    with instrument.timer('sample'):
+        sample_checkpointed(M, n_samples*5 + 2000, 2000, 5, checkpoint)
+    instrument.count('mcmc_iterations', M.n_sweeps - done)
+    return posterior_traces(M, transcripts)
+
+def count_nodes(M):
+    """Count the nodes of the model 'M' for instrument."""
+    if isinstance(M, NativeSampler):
+        instrument.count('native_parameters', len(M.log_sd))
+    else:
+        instrument.count('model_nodes', len(M.stochastics) +
+                         len(M.observed_stochastics) +
+                         len(M.deterministics) + len(M.potentials))
+
+def sample_comparisons(db, pairs, transcripts, n_samples=500, method='pymc',
+                       oneway=False):
+    """Sample the posterior of 'transcripts' for each of 'pairs' of groups.
+
+    The data of every sample in any of 'pairs' is read once with
+    load_groups and shared by all the comparisons.  If 'oneway' is
+    True, a single model of all the groups is fit with
+    build_oneway_model instead of one model per pair, and 'method' is
+    ignored.  Returns a dictionary of pairs to traces, as
+    posterior_traces returns them.
+    """
+    groups = [g for p in pairs for g in p]
+    loaded = load_groups(db, groups, transcripts)
+    if oneway:
+        with instrument.timer('build_model'):
+            M = build_oneway_model(db, groups, transcripts, loaded=loaded)
+        count_nodes(M)
+        with instrument.timer('sample'):
+            M.sample(n_samples*5 + 2000, burn=2000, thin=5)
+        instrument.count('mcmc_iterations', n_samples*5 + 2000)
+        return comparison_traces(M, pairs, transcripts)
+    return dict([((g1,g2), sample_posterior(db, g1, g2, transcripts,
+                                            n_samples=n_samples,
+                                            method=method, loaded=loaded))
+                 for (g1,g2) in pairs])
+
+def build_oneway_model(db, groups, transcripts, loaded=None):
+    """Build one model of 'transcripts' across all of 'groups'.
+
+    Instead of a single a with covariates of +0.5 and -0.5 for two
+    groups, each group g has its own array of effects a_g, so the
+    Beta distribution of r for a sample of group g has mean
+    exp(-minusmu + a_g).  Each a_g has a Cauchy prior with half the
+    scale of a in build_model, which is the prior that 0.5*a has
+    there.  The comparison of two groups x and y is then a = a_x -
+    a_y, and the mean of the pair is exp(-minusmu + (a_x + a_y)/2),
+    which comparison_traces computes.  The model is built with array
+    valued nodes, as in build_vector_model.  'loaded' is as for
+    build_model.
+    """
+    groups = sorted(set(groups))
+    if loaded == None:
+        loaded = load_groups(db, groups, transcripts)
+    n_transcripts = loaded['n_transcripts']
+    N = len(transcripts)
+    gamma_alpha = 5230.0/np.sqrt(n_transcripts)
+    gamma_beta = 1/(2.1e-3 * np.sqrt(n_transcripts))
+    minusmu = Gamma('minusmu', alpha=gamma_alpha, beta=gamma_beta,
+                    value=(gamma_alpha/gamma_beta)*np.ones(N))
+    a = dict([(g, Cauchy('a-group'+str(g), 0, 14.5, value=np.zeros(N)))
+              for g in groups])
+
+    def _maintain(minusmu=None, a=None):
+        for effect in a:
+            logp = -1*minusmu + effect
+            if np.any(alphas_of(logp) <= 0) or np.any(betas_of(logp) <= 0):
+                return -np.inf
+        return 0
+    maintain_beta = Potential(logp = _maintain,
+                              name = 'maintain_beta',
+                              parents = {'minusmu': minusmu,
+                                         'a': [a[g] for g in groups]},
+                              doc = 'Maintain beta parameters positive',
+                              verbose = 0,
+                              cache_depth = 2)
+
+    def _alphas(minusmu=None, a=None):
+        return alphas_of(-1*minusmu + a)
+
+    def _betas(minusmu=None, a=None):
+        return betas_of(-1*minusmu + a)
+
+    def make_mean(T, arrays):
+        def _pm(rs=None):
+            return vector_multiplicity_correction(T, rs, *arrays)
+        return _pm
+
+    nodes = [minusmu, maintain_beta] + a.values()
+    for g in groups:
+        alphas = Deterministic(eval=_alphas,
+                               doc='',
+                               name='alphas-group'+str(g),
+                               parents={'minusmu':minusmu, 'a':a[g]},
+                               trace=False,
+                               verbose=0,
+                               dtype=float,
+                               plot=False,
+                               cache_depth=2)
+        betas = Deterministic(eval=_betas,
+                              doc='',
+                              name='betas-group'+str(g),
+                              parents={'minusmu':minusmu, 'a':a[g]},
+                              trace=False,
+                              verbose=0,
+                              dtype=float,
+                              plot=False,
+                              cache_depth=2)
+        nodes.extend([alphas, betas])
+        for s,T in loaded['n_reads'][g].iteritems():
+            arrays = sample_arrays(loaded['samples'][s], transcripts)
+            r = Beta('r-group'+str(g)+'-'+str(s),
+                     alpha=alphas, beta=betas, trace=True)
+            poisson_mean = Deterministic(eval=make_mean(T, arrays[1:]),
+                                         doc='Corrected means for Poisson distribution',
+                                         name='poisson_mean-group'+str(g)+'-'+str(s),
+                                         parents={'rs': r},
+                                         trace=False,
+                                         verbose=0,
+                                         dtype=float,
+                                         plot=False,
+                                         cache_depth=2)
+            observation = Poisson('d-group'+str(g)+'-'+str(s),
+                                  mu=poisson_mean,
+                                  observed=True, value=arrays[0])
+            nodes.extend([r, poisson_mean, observation])
+    return MCMC(nodes)
+
+def comparison_traces(M, pairs, transcripts):
+    """Fetch the traces of each of 'pairs' from 'M' after sampling.
+
+    'M' is an MCMC returned by build_oneway_model.  Returns a
+    dictionary of pairs to traces as posterior_traces returns them,
+    with minusmu and a of each pair defined as in build_model's
+    two group model.
+    """
+    minusmu = M.trace('minusmu')[:]
+    r = {}
+    for (g1,g2) in pairs:
+        a1 = M.trace('a-group'+str(g1))[:]
+        a2 = M.trace('a-group'+str(g2))[:]
+        r[(g1,g2)] = dict([(t, {'minusmu': minusmu[:,i] - 0.5*(a1[:,i] + a2[:,i]),
+                                'a': a1[:,i] - a2[:,i]})
+                           for i,t in enumerate(transcripts)])
+    return r
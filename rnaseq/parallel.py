@@ -0,0 +1,127 @@
+"""
+Run inference on many subproblems in a pool of worker processes.
+
+Subproblems are independent by construction, so they can be sampled
+in any order on any number of cores.  Each worker opens the database
+read only and sends its traces back to the parent, which is the only
+process that writes to the database.
+
+Chains of large subproblems can be checkpointed to a directory as
+they run (see sample_posterior), so a run that is killed partway
+through one doesn't have to start it over.
+"""
+
+import os
+import sqlite3
+import multiprocessing
+from model import sample_posterior
+from diagnostics import diagnose, sample_until_converged
+from posteriors import posteriors_of_traces
+
+def open_read_only(db_filename):
+    """Open *db_filename* so that any attempt to write to it fails."""
+    db = sqlite3.connect(db_filename)
+    db.execute("""pragma query_only = 1""")
+    return db
+
+# Each worker process keeps its own handle on the database, opened by
+# _initialize_worker when the pool starts it.
+_db = None
+
+def _initialize_worker(db_filename):
+    global _db
+    _db = open_read_only(db_filename)
+
+def _sample_subproblem(args):
+    (group1, group2, transcripts, n_samples, method, checkpoint,
+     target_ess, n_chains) = args
+    if method == 'map':
+        # Draws from the Laplace approximation are independent, so
+        # there is nothing to diagnose.
+        return (transcripts, sample_posterior(_db, group1, group2, transcripts,
+                                              n_samples=n_samples,
+                                              method=method), None)
+    elif target_ess == None:
+        traces = sample_posterior(_db, group1, group2, transcripts,
+                                  n_samples=n_samples, method=method,
+                                  checkpoint=checkpoint)
+        n_chains = 1
+    else:
+        (traces, diagnostics) = \
+            sample_until_converged(_db, group1, group2, transcripts,
+                                   target_ess=target_ess, n_chains=n_chains,
+                                   checkpoint=checkpoint)
+    return (transcripts, traces,
+            diagnose(posteriors_of_traces(traces), n_chains))
+
+def checkpoint_filename(checkpoint_dir, group1, group2, transcripts):
+    """Return the file the chain of *transcripts* is checkpointed to."""
+    return os.path.join(checkpoint_dir, "%d-%d_%d.checkpoint" % \
+                            (group1, group2, min(transcripts)))
+
+def sample_subproblems(db_filename, group1, group2, subproblems,
+                       n_samples=500, method='pymc', workers=1,
+                       checkpoint_dir=None, checkpoint_size=100,
+                       target_ess=None, n_chains=4):
+    """Sample the posterior of each of *subproblems*.
+
+    Returns an iterator of (transcripts, traces, diagnostics) tuples,
+    in the order the subproblems finish, where traces is as returned
+    by sample_posterior, and diagnostics is diagnose of the
+    posteriors of those traces, ready for write_posteriors (or None
+    for the 'map' method).  With *workers* greater than one, the subproblems are
+    farmed out to a pool of that many processes, largest first, so a
+    single large subproblem doesn't start last and leave the other
+    workers idle at the end.
+
+    If *checkpoint_dir* is given, the chains of subproblems of at
+    least *checkpoint_size* transcripts are checkpointed to files in
+    it, and continued from there if the files already exist.  Only
+    the 'native' method can be checkpointed.
+
+    If *target_ess* is given, each subproblem is sampled with
+    sample_until_converged in *n_chains* chains, until every trace
+    has that effective sample size, instead of for a fixed number of
+    sweeps.  This also needs the 'native' method.  Each checkpoint is
+    removed when the caller asks for the next result, so write the
+    traces before then.
+    """
+    if checkpoint_dir != None and method != 'native':
+        raise ValueError("Only the native method can be checkpointed, not %s" % method)
+    if target_ess != None and method != 'native':
+        raise ValueError("Only the native method can sample until converged, not %s" % method)
+    subproblems = sorted(subproblems, key=len, reverse=True)
+    jobs = []
+    for transcripts in subproblems:
+        if checkpoint_dir != None and len(transcripts) >= checkpoint_size:
+            checkpoint = checkpoint_filename(checkpoint_dir, group1, group2,
+                                             transcripts)
+        else:
+            checkpoint = None
+        jobs.append((group1, group2, transcripts, n_samples, method,
+                     checkpoint, target_ess, n_chains))
+    checkpoints = dict([(min(job[2]), job[5]) for job in jobs])
+
+    def _finished(transcripts):
+        checkpoint = checkpoints[min(transcripts)]
+        if checkpoint != None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    if workers <= 1:
+        _initialize_worker(db_filename)
+        for job in jobs:
+            result = _sample_subproblem(job)
+            yield result
+            _finished(result[0])
+        return
+    pool = multiprocessing.Pool(workers, _initialize_worker, (db_filename,))
+    try:
+        for result in pool.imap_unordered(_sample_subproblem, jobs):
+            yield result
+            _finished(result[0])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
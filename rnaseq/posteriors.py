@@ -0,0 +1,248 @@
+"""
+Write posterior samples to the database and read them back.
+
+Posteriors are dictionaries with transcript IDs as keys, each
+referring to a dictionary with keys 'mu' and 'a' and numpy arrays of
+samples from the posterior as values, as pickled by inference.py.
+
+There are two layouts.  posterior_samples has one row per sample of
+each variable of each transcript.  posterior_traces has one row per
+variable of each transcript, holding the whole trace as a BLOB of
+float32 values, which is far smaller and faster to write.
+
+Whichever layout is used, write_posteriors also fills in
+posterior_summaries with the mean, median, 95% credible interval and
+probability of being positive of each trace, so most questions can be
+answered without reading the samples at all.
+
+Long runs record each subproblem in completed_subproblems in the same
+transaction as its posteriors, so a run that is stopped partway can
+be restarted with only the subproblems that never finished.
+
+Each inference is tagged with the method that produced it: 'mcmc' for
+sampling, or 'map' for draws from the Laplace approximation at the
+posterior mode (see sample_posterior), so a quick screen and a full
+run of the same pair of groups can sit side by side.
+
+The convergence diagnostics of each trace (see diagnostics.py) can be
+written along with it to convergence_diagnostics.
+"""
+
+import numpy as np
+import sqlite3
+import instrument
+
+def posteriors_of_traces(traces):
+    """Convert *traces* as returned by posterior_traces into posteriors."""
+    return dict([(t, {'mu': -1*trace['minusmu'], 'a': trace['a']})
+                 for t,trace in traces.iteritems()])
+
+def swap_groups(posteriors):
+    """Return *posteriors* of group1 against group2 as group2 against group1.
+
+    a is the difference between the two groups, so it changes sign;
+    mu is their average, and stays as it is.
+    """
+    return dict([(t, {'mu': p['mu'], 'a': -1*p['a']})
+                 for t,p in posteriors.iteritems()])
+
+def initialize_methods(db):
+    """Add the method column to inferences in databases from before it existed.
+
+    Their inferences were all sampled, so they are tagged 'mcmc'.
+    Such databases still allow only one inference per pair of groups.
+    """
+    columns = [c[1] for c in db.execute("""pragma table_info(inferences)""")]
+    if not('method' in columns):
+        db.execute("""alter table inferences
+                      add column method text not null default 'mcmc'""")
+
+def insert_inference(db, group1, group2, method='mcmc'):
+    """Return the ID of the *method* inference comparing *group1* and *group2*.
+
+    The inference is created if it doesn't exist yet.  Inferences are
+    stored with the smaller group ID first, so if *group1* is larger
+    than *group2*, pass posteriors through swap_groups before writing
+    them to this inference.
+    """
+    initialize_methods(db)
+    (group1, group2) = (min(group1,group2), max(group1,group2))
+    q = db.execute("""select id from inferences
+                      where group1=? and group2=? and method=?""",
+                   (group1,group2,method)).fetchone()
+    if q != None:
+        return q[0]
+    db.execute("""insert into inferences(group1,group2,method)
+                  values (?,?,?)""", (group1, group2, method))
+    (inference,) = db.execute("""select last_insert_rowid()""").fetchone()
+    return inference
+
+def initialize_completed(db):
+    """Create the table of subproblems whose posteriors are in *db*.
+
+    Each subproblem is identified by its smallest transcript.  The
+    table is created by initialize_database, and here for databases
+    from before it existed.
+    """
+    db.execute("""
+               create table if not exists completed_subproblems (
+                   inference integer references inferences(id),
+                   subproblem integer references transcripts(id),
+                   primary key (inference,subproblem)
+               )
+               """)
+
+def initialize_diagnostics(db):
+    """Create the table of convergence diagnostics of the traces in *db*.
+
+    The table is created by initialize_database, and here for
+    databases from before it existed.
+    """
+    db.execute("""
+               create table if not exists convergence_diagnostics (
+                   inference integer references inferences(id),
+                   transcript integer references transcripts(id),
+                   variable text not null,
+                   ess float not null,
+                   rhat float not null,
+                   n_chains integer not null,
+                   n_draws integer not null,
+                   primary key (inference,transcript,variable)
+               )
+               """)
+
+def completed_subproblems(db, inference):
+    """Return the set of subproblems of *inference* already written to *db*.
+
+    Each is given by its smallest transcript, as for the *subproblem*
+    argument of write_posteriors.
+    """
+    initialize_completed(db)
+    return set([x for (x,) in
+                db.execute("""select subproblem from completed_subproblems
+                              where inference=?""", (inference,))])
+
+def encode_trace(trace):
+    """Encode the numpy array *trace* as a BLOB of float32 values."""
+    return sqlite3.Binary(np.asarray(trace, dtype=np.float32).tostring())
+
+def decode_trace(blob):
+    """Decode a BLOB written by encode_trace back into a numpy array."""
+    return np.frombuffer(blob, dtype=np.float32)
+
+def summarize(trace):
+    """Return the mean, median, 95% credible interval and P(x>0) of *trace*."""
+    trace = np.asarray(trace, dtype=float)
+    (lower, median, upper) = np.percentile(trace, [2.5, 50, 97.5])
+    return (float(np.mean(trace)), float(median), float(lower), float(upper),
+            float(np.mean(trace > 0)))
+
+def write_posteriors(db, inference, posteriors, blobs=False,
+                     subproblem=None, diagnostics=None):
+    """Write *posteriors* of *inference* to *db* and commit.
+
+    If *blobs* is True, each trace is written as a single row of
+    posterior_traces.  Otherwise each sample is a row of
+    posterior_samples.  Either way all the rows go in with one
+    executemany, and a summary of each trace is written to
+    posterior_summaries.
+
+    If *subproblem* is given, it is the list of transcripts that
+    *posteriors* covers, and it is marked as done in
+    completed_subproblems in the same transaction.  If *diagnostics*
+    is given, it is the result of rnaseq.diagnostics.diagnose on
+    *posteriors*, and is written to convergence_diagnostics.
+    """
+    with instrument.timer('write_posteriors'):
+        _write_posteriors(db, inference, posteriors, blobs, subproblem,
+                          diagnostics)
+
+def _write_posteriors(db, inference, posteriors, blobs, subproblem,
+                      diagnostics):
+    db.executemany("""insert into posterior_summaries
+                      (inference,transcript,variable,mean,median,
+                       lower,upper,p_positive)
+                      values (?,?,?,?,?,?,?,?)""",
+                   ((inference, t, variable) + summarize(trace)
+                    for t,samples in posteriors.iteritems()
+                    for variable,trace in samples.iteritems()))
+    if blobs:
+        db.executemany("""insert into posterior_traces
+                          (inference,transcript,variable,trace)
+                          values (?,?,?,?)""",
+                       ((inference, t, variable, encode_trace(trace))
+                        for t,samples in posteriors.iteritems()
+                        for variable,trace in samples.iteritems()))
+    else:
+        db.executemany("""insert into posterior_samples
+                          (inference,transcript,variable,sample,value)
+                          values (?,?,?,?,?)""",
+                       ((inference, t, variable, i, float(v))
+                        for t,samples in posteriors.iteritems()
+                        for variable,trace in samples.iteritems()
+                        for i,v in enumerate(trace)))
+    if diagnostics != None:
+        initialize_diagnostics(db)
+        db.executemany("""insert into convergence_diagnostics
+                          (inference,transcript,variable,ess,rhat,
+                           n_chains,n_draws)
+                          values (?,?,?,?,?,?,?)""",
+                       ((inference, t, variable) + tuple(d)
+                        for t,variables in diagnostics.iteritems()
+                        for variable,d in variables.iteritems()))
+    if subproblem != None:
+        initialize_completed(db)
+        db.execute("""insert into completed_subproblems(inference,subproblem)
+                      values (?,?)""", (inference, min(subproblem)))
+    db.commit()
+
+def read_posterior(db, inference, transcript, variable):
+    """Fetch the trace of *variable* of *transcript* in *inference*.
+
+    Returns a numpy array, whichever layout the trace was written in.
+    """
+    q = db.execute("""select trace from posterior_traces
+                      where inference=? and transcript=? and variable=?""",
+                   (inference, transcript, variable)).fetchone()
+    if q != None:
+        return decode_trace(q[0])
+    c = db.execute("""select value from posterior_samples
+                      where inference=? and transcript=? and variable=?
+                      order by sample""", (inference, transcript, variable))
+    trace = np.array([v for (v,) in c])
+    if len(trace) == 0:
+        raise ValueError("No posterior for variable %s of transcript %d in inference %d" % \
+                             (variable, transcript, inference))
+    return trace
+
+def flagged_transcripts(db, inference, p=0.95):
+    """Return the transcripts of *inference* worth a closer look.
+
+    A transcript is flagged if the posterior probability that a is
+    positive is at least *p*, or at most 1-*p*.  This is how a 'map'
+    inference picks the transcripts to sample in full.
+    """
+    return [x for (x,) in
+            db.execute("""select transcript from posterior_summaries
+                          where inference=? and variable='a'
+                          and max(p_positive, 1-p_positive) >= ?""",
+                       (inference, p))]
+
+def rank_transcripts(db, inference, limit=None):
+    """Rank the transcripts of *inference* by evidence of differential expression.
+
+    The evidence for a transcript is how far the posterior
+    probability that a is positive is from one half, in either
+    direction; ties are broken by the size of the posterior mean of
+    a.  Returns a list of tuples (transcript, mean, lower, upper,
+    p_positive) describing the posterior of a, most differentially
+    expressed first.  If *limit* is given, only that many transcripts
+    are returned.
+    """
+    query = """select transcript,mean,lower,upper,p_positive
+               from posterior_summaries
+               where inference=? and variable='a'
+               order by max(p_positive, 1-p_positive) desc, abs(mean) desc"""
+    if limit != None:
+        query += """ limit %d""" % limit
+    return db.execute(query, (inference,)).fetchall()
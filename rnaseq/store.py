@@ -0,0 +1,161 @@
+"""
+A columnar store of samples in memory mapped numpy files.
+
+SQLite is a poor place to keep leftsites: inference only ever wants
+the dense vector of counts for a transcript, but has to rebuild it
+row by row.  A sample store is a directory holding, for each sample,
+one flat int32 array of the leftsites of every transcript laid end to
+end, plus a single index of the offset of each transcript in that
+array, shared by all samples.  Multiplicities are kept beside it,
+already laid out as get_sample returns them: one entry per transcript
+of each multiplicity, sorted by transcript, with an index of where
+each transcript's entries start.  All of these files are memory
+mapped, so reading a subproblem touches only its own entries.
+
+The SQLite database still holds everything else (sample groups,
+samples, transcripts, multiplicities), and records the path of its
+store in the table sample_store.  A database with no row in
+sample_store keeps its leftsites in SQLite as before.
+"""
+
+import os
+import sqlite3
+import numpy as np
+import instrument
+from bag import *
+
+def initialize_store(db, path):
+    """Create a sample store at *path* and record it in *db*.
+
+    *path* must be a directory which either doesn't exist or is empty.
+    """
+    path = os.path.abspath(path)
+    if not(os.path.exists(path)):
+        os.makedirs(path)
+    elif os.listdir(path) != []:
+        raise ValueError("Sample store directory %s is not empty." % path)
+    db.execute("""insert into sample_store(path) values (?)""", (path,))
+    db.commit()
+    return path
+
+def store_path(db):
+    """Return the path of the sample store of *db*, or None if it has none."""
+    try:
+        q = db.execute("""select path from sample_store""").fetchone()
+    except sqlite3.OperationalError:
+        # Databases from before sample stores existed have no
+        # sample_store table.
+        return None
+    if q == None:
+        return None
+    else:
+        return q[0]
+
+def leftsites_filename(path, sample):
+    return os.path.join(path, "sample%d.leftsites.npy" % sample)
+
+# The arrays of multiplicity entries of each sample, each in its own
+# file so that it can be memory mapped.  The entries of transcript t
+# are offsets[t]:offsets[t+1] of positions and counts.  The targets of
+# entry i are targets[starts[i]:starts[i+1]].
+MULTIPLICITY_ARRAYS = ['offsets', 'positions', 'counts', 'starts', 'targets']
+
+def multiplicities_filename(path, sample, array):
+    return os.path.join(path, "sample%d.multiplicity_%s.npy" % (sample, array))
+
+def offsets_filename(path):
+    return os.path.join(path, "offsets.npy")
+
+def write_sample(path, sample, leftsites, multiplicities):
+    """Write *leftsites* and *multiplicities* of *sample* to the store at *path*.
+
+    *leftsites* and *multiplicities* are as returned by
+    rnaseq.load.count_reads_and_multiplicities.  The offset index is
+    written along with the first sample.
+    """
+    offsets = np.zeros(len(leftsites)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in leftsites])
+    if os.path.exists(offsets_filename(path)):
+        if not(np.array_equal(np.load(offsets_filename(path)), offsets)):
+            raise ValueError(("Leftsites of sample %d do not match the " + \
+                                  "transcripts in sample store %s") % (sample,path))
+    else:
+        np.save(offsets_filename(path), offsets)
+
+    flat = np.lib.format.open_memmap(leftsites_filename(path, sample),
+                                     mode='w+', dtype=np.int32,
+                                     shape=(int(offsets[-1]),))
+    for t,counts in enumerate(leftsites):
+        flat[offsets[t]:offsets[t+1]] = counts
+    flat.flush()
+    del flat
+
+    entries = sorted(multiplicity_entries(multiplicities),
+                     key=lambda e: e[0])
+    arrays = {'offsets': np.searchsorted([t for (t,p,n,ts) in entries],
+                                         np.arange(len(leftsites)+1)),
+              'positions': [p for (t,p,n,ts) in entries],
+              'counts': [n for (t,p,n,ts) in entries],
+              'starts': np.concatenate([[0], np.cumsum([len(ts) for
+                                                        (t,p,n,ts) in entries])]),
+              'targets': [x for (t,p,n,ts) in entries for x in ts]}
+    n_bytes = os.path.getsize(leftsites_filename(path, sample))
+    for name in MULTIPLICITY_ARRAYS:
+        dtype = np.int64 if name in ('offsets', 'starts') else np.int32
+        np.save(multiplicities_filename(path, sample, name),
+                np.array(arrays[name], dtype=dtype))
+        n_bytes += os.path.getsize(multiplicities_filename(path, sample, name))
+    instrument.count('store_bytes_written', n_bytes)
+
+def multiplicity_entries(multiplicities):
+    """Yield the entries get_sample would read from *multiplicities*.
+
+    *multiplicities* is as returned by
+    rnaseq.load.count_reads_and_multiplicities.  Yields a tuple
+    (transcript, position, count, targets) for each transcript of
+    each multiplicity that has alignments to other transcripts, in
+    the same form as the SQL queries of get_sample build them.
+    """
+    for targets,n in multiplicities.iteritems():
+        transcripts = [t for (t,p) in targets]
+        for t in sorted(set(transcripts)):
+            k = transcripts.count(t)
+            others = [u for u in transcripts if u != t]
+            if others == []:
+                continue
+            position = targets[transcripts.index(t)][1]
+            yield (t, position, n, tuple([u for u in others for i in range(k)]))
+
+def read_sample(path, sample_id, transcripts):
+    """Fetch leftsites and multiplicities for *transcripts* in *sample_id*.
+
+    Returns the same structure as rnaseq.model.get_sample.  The
+    leftsites arrays are read only views of the memory mapped file of
+    the sample, so no counts are copied.
+    """
+    if not(os.path.exists(leftsites_filename(path, sample_id))):
+        raise ValueError("No sample %d in sample store %s" % (sample_id, path))
+    offsets = np.load(offsets_filename(path))
+    flat = np.load(leftsites_filename(path, sample_id), mmap_mode='r')
+    m = dict([(name, np.load(multiplicities_filename(path, sample_id, name),
+                             mmap_mode='r'))
+              for name in MULTIPLICITY_ARRAYS])
+
+    r = {}
+    target_sets = TargetSets()
+    for t in transcripts:
+        if t < 0 or t >= len(offsets)-1:
+            raise ValueError("No transcript with ID %d for sample %d in database" % (t,sample_id))
+        (first, last) = (m['offsets'][t], m['offsets'][t+1])
+        starts = m['starts'][first:last+1]
+        targets = m['targets'][starts[0]:starts[-1]]
+        set_ids = [target_sets.intern(tuple([int(x) for x in
+                                             targets[starts[i]-starts[0]:
+                                                     starts[i+1]-starts[0]]]))
+                   for i in range(last-first)]
+        r[t] = {'leftsites': flat[offsets[t]:offsets[t+1]],
+                'multiplicities': MultiplicityTable(target_sets,
+                                                    m['positions'][first:last],
+                                                    set_ids,
+                                                    m['counts'][first:last])}
+    return r
@@ -1,20 +1,207 @@
-import networkx as nx
 import sqlite3
+import heapq
+import instrument
+
+class UnionFind(object):
+    """Disjoint sets of the integers 0 to n-1, kept in a flat array.
+
+    Each element points to a parent in the same set, and the root of
+    each tree of parents names the set.  find uses path halving and
+    union joins by size, so any sequence of operations runs in nearly
+    linear time.
+    """
+    def __init__(self, n):
+        self.parent = range(n)
+        self.size = [1]*n
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x == y:
+            return x
+        if self.size[x] < self.size[y]:
+            (x,y) = (y,x)
+        self.parent[y] = x
+        self.size[x] += self.size[y]
+        return x
+    def components(self, elements):
+        """Group *elements* by set.
+
+        Returns a list of sorted lists, largest first, in the same
+        form as NetworkX's connected_components.
+        """
+        groups = {}
+        for x in elements:
+            groups.setdefault(self.find(x), []).append(x)
+        r = [sorted(g) for g in groups.itervalues()]
+        r.sort(key=lambda g: (-len(g), g[0]))
+        return r
+
+def initialize_subproblems(db):
+    """Create the table holding the stored subproblems of *db*.
+
+    The table is a union-find over transcripts, kept fully compressed:
+    each transcript points directly at the root transcript of its
+    subproblem.  It is created by initialize_database, and here for
+    databases from before subproblems were stored.
+    """
+    db.execute("""
+               create table if not exists subproblems (
+                   transcript integer primary key references transcripts(id),
+                   component integer not null references transcripts(id)
+               )
+               """)
+
+def stored_union_find(db):
+    """Return a UnionFind of the subproblems stored in *db*."""
+    rows = db.execute("""select transcript,component from subproblems""").fetchall()
+    n = max([max(t,c) for (t,c) in rows]) + 1 if rows != [] else 0
+    uf = UnionFind(n)
+    uf.size = [0]*n
+    for (t,c) in rows:
+        uf.parent[t] = c
+        uf.size[c] += 1
+    return uf
+
+def union_multiplicities(uf, rows):
+    """Join the transcripts of each multiplicity in *rows* in *uf*.
+
+    *rows* must be (multiplicity, transcript) pairs ordered by
+    multiplicity.
+    """
+    last_multiplicity = None
+    for (m,t) in rows:
+        if m != last_multiplicity:
+            first = t
+            last_multiplicity = m
+        else:
+            uf.union(first, t)
+
+def update_subproblems(db, sample):
+    """Add the multiplicities of *sample* to the subproblems stored in *db*.
+
+    Only the multiplicity entries of *sample* are read, so the cost
+    does not grow with the number of samples already loaded.  If *db*
+    has no stored subproblems yet, they are computed from all the
+    multiplicities in it.
+
+    Nothing is committed, so call this in the same transaction that
+    writes *sample*, and commit once afterwards: then the stored
+    subproblems can never be missing a sample that was committed.
+    The subproblems table must already exist (see
+    initialize_subproblems), since creating a table would commit the
+    transaction early.
+    """
+    with instrument.timer('update_subproblems'):
+        _update_subproblems(db, sample)
+
+def _update_subproblems(db, sample):
+    transcripts = [x for (x,) in db.execute("""select id from transcripts""")]
+    n_stored = db.execute("""select count(*) from subproblems""").fetchone()[0]
+    if n_stored == 0:
+        uf = UnionFind(max(transcripts)+1 if transcripts != [] else 0)
+        old = {}
+        c = db.execute("""select multiplicity,transcript from multiplicity_entries
+                          order by multiplicity""")
+    else:
+        uf = stored_union_find(db)
+        old = dict([(t,uf.parent[t]) for t in transcripts])
+        c = db.execute("""select a.multiplicity,a.transcript 
+                          from multiplicity_entries as a
+                          join multiplicities as b
+                          on a.multiplicity = b.id
+                          where b.sample = ?
+                          order by a.multiplicity""", (sample,))
+    union_multiplicities(uf, c)
+    changed = [(t,uf.find(t)) for t in transcripts
+               if old.get(t) != uf.find(t)]
+    db.executemany("""insert or replace into subproblems(transcript,component)
+                      values (?,?)""", changed)
+
+def rebuild_subproblems(db):
+    """Recompute the subproblems stored in *db* from all its multiplicities.
+
+    This repairs the stored subproblems after loading was interrupted
+    between writing a sample and updating them.
+    """
+    initialize_subproblems(db)
+    db.execute("""delete from subproblems""")
+    update_subproblems(db, None)
+    db.commit()
 
 def find_subproblems(db):
-    g = build_graph(db)
-    return nx.connected_components(g)
-
-def build_graph(db):
-    g = nx.Graph()
-    [g.add_node(x) for (x,) in db.execute("""select id from transcripts""")]
-    mids = [x for (x,) in db.execute("""select id from multiplicities""")]
-    for mid in mids:
-        pairs = db.execute("""select a.transcript,b.transcript 
-                              from multiplicity_entries as a
-                              join multiplicity_entries as b
-                              on a.multiplicity=? and b.multiplicity=?
-                              and a.transcript < b.transcript""",
-                           (mid,mid))
-        [g.add_edge(x,y) for (x,y) in pairs]
-    return g
+    """Find the sets of transcripts in *db* linked by multireads.
+
+    Two transcripts are in the same subproblem if any read maps to
+    both of them in any sample.  Returns a list of sorted lists of
+    transcript IDs, largest first.  Transcripts with no multireads are
+    returned as subproblems of their own.
+
+    If *db* has stored subproblems (see update_subproblems), they are
+    read directly.  Otherwise they are computed with one scan of
+    multiplicity_entries.
+    """
+    with instrument.timer('find_subproblems'):
+        return _find_subproblems(db)
+
+def _find_subproblems(db):
+    transcripts = [x for (x,) in db.execute("""select id from transcripts""")]
+    try:
+        n_stored = db.execute("""select count(*) from subproblems""").fetchone()[0]
+    except sqlite3.OperationalError:
+        n_stored = 0
+    if transcripts != [] and n_stored == len(transcripts):
+        return stored_union_find(db).components(transcripts)
+    uf = UnionFind(max(transcripts)+1 if transcripts != [] else 0)
+    c = db.execute("""select multiplicity,transcript from multiplicity_entries
+                      order by multiplicity""")
+    union_multiplicities(uf, c)
+    return uf.components(transcripts)
+
+def missing_transcripts(db, transcripts):
+    """Return the transcripts outside *transcripts* that share multireads with it.
+
+    *transcripts* is a complete subproblem exactly when this is empty.
+    """
+    ts = '(' + ','.join([str(int(t)) for t in transcripts]) + ')'
+    query = """select distinct a.transcript
+               from (select * from multiplicity_entries
+                     where transcript not in %s) as a
+               join (select * from multiplicity_entries 
+                     where transcript in %s) as b
+               on a.multiplicity = b.multiplicity
+            """ % (ts, ts)
+    return [x for (x,) in db.execute(query)]
+
+def pack_subproblems(subproblems, n_jobs, cost=len):
+    """Split *subproblems* into at most *n_jobs* lists of roughly equal cost.
+
+    *cost* estimates the cost of running a subproblem, by default its
+    number of transcripts.  Subproblems are placed largest first, each
+    into the job with the least total cost so far.  Returns a list of
+    jobs, each a list of subproblems, with no empty jobs.
+    """
+    heap = [(0, i, []) for i in range(n_jobs)]
+    for sp in sorted(subproblems, key=cost, reverse=True):
+        (total, i, job) = heapq.heappop(heap)
+        job.append(sp)
+        heapq.heappush(heap, (total + cost(sp), i, job))
+    return [job for (total, i, job) in sorted(heap, key=lambda x: x[1])
+            if job != []]
+
+def write_subproblems(filename, subproblems):
+    """Write *subproblems* to *filename*, one per line, as find_subproblems.py prints them."""
+    with open(filename, 'w') as f:
+        for sp in subproblems:
+            print >>f, ' '.join([str(t) for t in sp])
+
+def read_subproblems(filename):
+    """Read a list of subproblems written by write_subproblems or find_subproblems.py."""
+    with open(filename) as f:
+        return [[int(t) for t in line.split()] for line in f
+                if line.strip() != '']
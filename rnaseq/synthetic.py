@@ -0,0 +1,151 @@
+"""
+Generate synthetic RNASeq data from the model in model.pyx.
+
+The parameters of each transcript are drawn as build_model describes
+them: minusmu from its Gamma prior, a as zero for most transcripts
+and drawn for a fraction of differentially expressed ones, and r of
+each transcript in each sample from the Beta distribution those give.
+Reads are then drawn with a Poisson number per transcript and a
+uniform leftsite, and written as SAM files grouped by read name, the
+way bowtie leaves them, ready for load_sam.
+
+Multireads come from families of transcripts, standing in for
+paralogs.  A read from a transcript in a family of more than one
+aligns, with some probability, to other members of its family as
+well, so each family becomes a subproblem.
+
+build_model's prior puts each transcript at about e^-11 of the reads,
+which is right for a whole transcriptome, but would make a synthetic
+transcriptome of a few thousand transcripts nearly all unmapped reads.
+So minusmu is shifted by a constant after it is drawn, to make the
+transcripts account for a given fraction of the reads.  The rest are
+written as unmapped reads, so each sample has its full number of
+reads in the database.
+"""
+
+import os
+import numpy as np
+from model import alphas_of, betas_of
+
+READ_LENGTH = 38
+
+def simulate_parameters(n_transcripts, min_length=200, max_length=2000,
+                        family_size=3, de_fraction=0.1, de_scale=1.0,
+                        mapped_fraction=0.9, rng=np.random):
+    """Draw the true parameters of *n_transcripts* transcripts.
+
+    Lengths are uniform between *min_length* and *max_length*.
+    Transcripts are dealt into families of *family_size* in order, so
+    transcript t is in family t // *family_size*.  A fraction
+    *de_fraction* of transcripts have a drawn from a normal
+    distribution with standard deviation *de_scale*; the rest have a
+    of zero.  *rng* is a numpy RandomState, or numpy.random itself.
+
+    Returns a dictionary with keys 'lengths', 'families', 'minusmu'
+    and 'a', each a numpy array with one entry per transcript.
+    """
+    lengths = rng.randint(min_length, max_length+1, size=n_transcripts)
+    families = np.arange(n_transcripts) // max(family_size, 1)
+    minusmu = rng.gamma(5230.0/np.sqrt(n_transcripts),
+                        2.1e-3*np.sqrt(n_transcripts), size=n_transcripts)
+    minusmu += np.log(np.sum(np.exp(-minusmu)) / mapped_fraction)
+    a = np.where(rng.random_sample(n_transcripts) < de_fraction,
+                 rng.normal(0, de_scale, size=n_transcripts), 0.0)
+    # Keep exp(-minusmu + a/2) and exp(-minusmu - a/2) below one, as
+    # the potential in build_model does.
+    a = np.clip(a, -2*(minusmu - 1e-3), 2*(minusmu - 1e-3))
+    return {'lengths': lengths, 'families': families,
+            'minusmu': minusmu, 'a': a}
+
+def simulate_r(parameters, covariate, rng=np.random):
+    """Draw r of every transcript for one sample with *covariate*.
+
+    Group 1 samples have a covariate of 0.5 and group 2 samples -0.5,
+    as in build_model.
+    """
+    logp = -parameters['minusmu'] + covariate*parameters['a']
+    return rng.beta(alphas_of(logp), betas_of(logp))
+
+def simulate_reads(parameters, r, n_reads, multiread_rate=0.05,
+                   rng=np.random):
+    """Draw the alignments of the reads of one sample.
+
+    Returns an iterator over reads, each a list of (transcript,
+    position) pairs, one for each of its alignments, with position the
+    leftsite counted from zero.  Reads from transcript t number
+    Poisson(r[t] * *n_reads*).  Each read is, with probability
+    *multiread_rate*, also aligned to between one and all of the other
+    transcripts of its family.  Unmapped reads are not included.
+    """
+    families = {}
+    for t,f in enumerate(parameters['families']):
+        families.setdefault(f, []).append(t)
+    lengths = parameters['lengths']
+    counts = rng.poisson(r * n_reads)
+    for t,n in enumerate(counts):
+        others = [u for u in families[parameters['families'][t]] if u != t]
+        positions = rng.randint(0, lengths[t]+1, size=n)
+        multi = rng.random_sample(n) < multiread_rate
+        for i in range(n):
+            read = [(t, int(positions[i]))]
+            if multi[i] and others != []:
+                k = rng.randint(1, len(others)+1)
+                for u in rng.permutation(others)[:k]:
+                    read.append((int(u), int(rng.randint(0, lengths[u]+1))))
+            yield read
+
+def write_sam(filename, parameters, reads, n_reads):
+    """Write *reads* as a SAM file grouped by read name.
+
+    *reads* is as returned by simulate_reads.  Unmapped reads are
+    added at the end to bring the total number of reads to *n_reads*.
+    Each alignment carries an NH tag giving the number of alignments
+    of its read.  Returns the number of mapped reads written.
+    """
+    with open(filename, 'w') as f:
+        f.write("@HD\tVN:1.0\tSO:queryname\n")
+        for t,length in enumerate(parameters['lengths']):
+            f.write("@SQ\tSN:transcript%d\tLN:%d\n" % (t, length + READ_LENGTH))
+        i = 0
+        for read in reads:
+            for j,(t,position) in enumerate(read):
+                f.write("read%010d\t%d\ttranscript%d\t%d\t255\t%dM\t*\t0\t0\t*\t*\tNH:i:%d\n" % \
+                            (i, 0 if j == 0 else 256, t, position+1,
+                             READ_LENGTH, len(read)))
+            i += 1
+        n_mapped = i
+        for i in range(n_mapped, n_reads):
+            f.write("read%010d\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*\n" % i)
+    return n_mapped
+
+def write_dataset(directory, n_transcripts, n_samples=(3,3), n_reads=1000000,
+                  multiread_rate=0.05, seed=None, **kwargs):
+    """Write a synthetic experiment of two groups of samples to *directory*.
+
+    *n_samples* gives the number of samples in each group, each with
+    *n_reads* reads.  Further keyword arguments are passed to
+    simulate_parameters.  The true parameters are saved in
+    truth.npz, with r of each sample in rows of 'r' in the order of
+    the files.
+
+    Returns a tuple (group1_files, group2_files, parameters).
+    """
+    rng = np.random.RandomState(seed)
+    if not(os.path.exists(directory)):
+        os.makedirs(directory)
+    parameters = simulate_parameters(n_transcripts, rng=rng, **kwargs)
+    files = ([], [])
+    rs = []
+    for g,covariate in [(0,0.5), (1,-0.5)]:
+        for s in range(n_samples[g]):
+            filename = os.path.join(directory,
+                                    "group%d-sample%d.sam" % (g+1, s+1))
+            r = simulate_r(parameters, covariate, rng=rng)
+            write_sam(filename, parameters,
+                      simulate_reads(parameters, r, n_reads,
+                                     multiread_rate=multiread_rate, rng=rng),
+                      n_reads)
+            files[g].append(filename)
+            rs.append(r)
+    np.savez(os.path.join(directory, "truth.npz"), r=np.array(rs), **parameters)
+    return (files[0], files[1], parameters)
@@ -25,6 +25,7 @@ setup(name='rnaseq',
       scripts=['bin/samfiles_to_sqlite.py', 'bin/find_subproblems.py', 
                'bin/inference.py', 
                'bin/simple_inference.py', 
-               'bin/workflow.py'],
+               'bin/workflow.py',
+               'bin/benchmark.py'],
       classifiers=['Topic :: Scientific/Engineering :: Bio-Informatics']
       )
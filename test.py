@@ -17,11 +17,187 @@ Traceback (most recent call last):
 ConfigurationError: File /dev/null/boris in configuration doesn't exist.
 
 
+Grouping reads.  SpilledGroups gives the same groups whether or not
+it spills to disk.
 
+>>> from rnaseq.load import *
+>>> reads = [FakeRead('a', 0, 5, 2), FakeRead('b', 1, 3, 2),
+...          FakeRead('c', 2, 7, 1), FakeRead('a', 1, 9, 2),
+...          FakeRead('d', -1, -1), FakeRead('b', 2, 4, 2)]
+>>> expected = [[('a', 0, 5), ('a', 1, 9)], [('b', 1, 3), ('b', 2, 4)],
+...             [('c', 2, 7)], [('d', -1, -1)]]
 
+>>> in_memory = SpilledGroups(max_reads=100)
+>>> spilled = SpilledGroups(max_reads=2, n_partitions=3)
+>>> for r in reads:
+...     in_memory.add(alignment_of(r))
+...     spilled.add(alignment_of(r))
+>>> (in_memory.directory, spilled.directory != None)
+(None, True)
+>>> summarize(in_memory.groups()) == expected
+True
+>>> directory = spilled.directory
+>>> summarize(spilled.groups()) == expected
+True
+>>> os.path.exists(directory)
+False
+>>> [g[0].is_unmapped for g in SpilledGroups(0).groups()]
+[]
 
+group_by_nh yields reads with one alignment at once, and gives the
+same groups as group_by_hash with or without spilling.
+
+>>> grouped = group_by_nh(reads)
+>>> [(a.qname, a.rname, a.pos) for a in grouped.next()]
+[('c', 2, 7)]
+>>> summarize(group_by_nh(reads)) == expected
+True
+>>> summarize(group_by_nh(reads, max_reads=1)) == expected
+True
+>>> summarize(group_by_hash(reads, max_reads=1)) == expected
+True
+
+A multiread missing some of its alignments is yielded as it is, and a
+read without an NH tag is an error.
+
+>>> summarize(group_by_nh(reads[:5], max_reads=1)) == \\
+...     [[('a', 0, 5), ('a', 1, 9)], [('b', 1, 3)], [('c', 2, 7)], [('d', -1, -1)]]
+True
+>>> list(group_by_nh([FakeRead('e', 0, 1)]))
+Traceback (most recent call last):
+  ...
+ValueError: Read e has no NH tag.  Group files without NH tags by name or by hash.
+
+
+Subproblems.  UnionFind joins sets by size.
+
+>>> from rnaseq.subproblems import *
+>>> uf = UnionFind(6)
+>>> for (x,y) in [(0,1), (2,3), (1,3)]:
+...     _ = uf.union(x, y)
+>>> uf.components(range(6))
+[[0, 1, 2, 3], [4], [5]]
+>>> uf.find(2) == uf.find(0)
+True
+
+Updating the stored subproblems one sample at a time gives the same
+subproblems as computing them from all the multiplicities at once.
+
+>>> import sqlite3
+>>> db = sqlite3.connect(':memory:')
+>>> initialize_database(db)
+>>> _ = db.executemany('''insert into transcripts(id,label,length)
+...                       values (?,?,100)''', [(i, 't%d' % i) for i in range(7)])
+>>> write_multiplicities(db, 1, {((0,1),(1,4)): 3, ((2,0),(3,0)): 1})
+>>> update_subproblems(db, 1)
+>>> find_subproblems(db)
+[[0, 1], [2, 3], [4], [5], [6]]
+>>> write_multiplicities(db, 2, {((1,2),(3,8),(5,5)): 2})
+>>> update_subproblems(db, 2)
+>>> incremental = find_subproblems(db)
+>>> incremental
+[[0, 1, 2, 3, 5], [4], [6]]
+>>> _ = db.execute('delete from subproblems')
+>>> find_subproblems(db) == incremental
+True
+>>> rebuild_subproblems(db)
+>>> find_subproblems(db) == incremental
+True
+
+pack_subproblems balances the total size of each job, placing the
+largest subproblems first.
+
+>>> pack_subproblems([[0], [1, 2, 3], [4, 5], [6], [7, 8]], 2)
+[[[1, 2, 3], [0], [6]], [[4, 5], [7, 8]]]
+>>> pack_subproblems([[0], [1, 2]], 5)
+[[[1, 2]], [[0]]]
+>>> pack_subproblems([[0, 1], [2], [3]], 2, cost=lambda sp: 1)
+[[[0, 1], [3]], [[2]]]
+
+
+Multiplicity tables merge entries with the same position and targets.
+
+>>> from rnaseq.bag import *
+>>> sets = TargetSets()
+>>> (sets.intern((1, 2)), sets.intern((3,)), sets.intern((1, 2)))
+(0, 1, 0)
+>>> m = MultiplicityTable(sets, [5, 3, 5, 5], [0, 0, 1, 0])
+>>> (len(m), len(m.positions))
+(4, 3)
+>>> sorted(m.itercounts())
+[((3, (1, 2)), 1), ((5, (1, 2)), 2), ((5, (3,)), 1)]
+>>> m = MultiplicityTable(sets, [5, 3, 5], [0, 0, 0], [2, 1, 4])
+>>> (len(m), sorted(m.itercounts()))
+(7, [((3, (1, 2)), 1), ((5, (1, 2)), 6)])
+>>> sorted(m.iterunique())
+[(3, (1, 2)), (5, (1, 2))]
+>>> (bool(m), bool(MultiplicityTable()), len(MultiplicityTable()))
+(True, False, 0)
+
+set_arrays numbers the target sets used by the table from zero.
+
+>>> m = MultiplicityTable(sets, [0, 1, 2], [1, 1, 0], [1, 1, 1])
+>>> [a.tolist() for a in m.set_arrays()]
+[[1, 1, 0], [1, 2, 3], [0, 2]]
+>>> [a.tolist() for a in m.set_arrays({1: 10, 2: 20, 3: 30})]
+[[1, 1, 0], [10, 20, 30], [0, 2]]
+
+
+Convergence diagnostics on AR(1) chains, whose effective sample size
+is m*n*(1-phi)/(1+phi).
+
+>>> from rnaseq.diagnostics import *
+>>> rng = np.random.RandomState(17)
+>>> chains = ar1(rng, 0.5, 4, 4000)
+>>> abs(effective_sample_size(chains) / (4*4000/3.0) - 1) < 0.1
+True
+>>> chains = ar1(rng, 0.9, 4, 4000)
+>>> abs(effective_sample_size(chains) / (4*4000*0.1/1.9) - 1) < 0.2
+True
+>>> split_rhat(chains) < 1.01
+True
+
+Chains started in different places, or still drifting, have an R-hat
+well above one.
+
+>>> split_rhat(ar1(rng, 0.99, 4, 500) + np.arange(4)[:,np.newaxis]) > 1.1
+True
+>>> split_rhat(ar1(rng, 0.5, 4, 1000) + np.linspace(0, 5, 1000)) > 1.1
+True
+>>> (effective_sample_size(np.ones((2, 100))), split_rhat(np.ones((2, 100))))
+(200.0, 1.0)
 """
 
+import os
+import numpy as np
+
+class FakeRead(object):
+    """A read with the fields of a pysam read that the loaders use."""
+    def __init__(self, qname, rname, pos, nh=None):
+        self.qname = qname
+        self.rname = rname
+        self.pos = pos
+        self.is_unmapped = rname < 0
+        self.nh = nh
+    def opt(self, tag):
+        if tag != 'NH' or self.nh == None:
+            raise KeyError(tag)
+        return self.nh
+
+def summarize(groups):
+    """Reduce *groups* of Alignments to a sorted list of tuples."""
+    return sorted([sorted([(a.qname, a.rname, a.pos) for a in g])
+                   for g in groups])
+
+def ar1(rng, phi, m, n):
+    """Return *m* AR(1) chains of length *n* with coefficient *phi*."""
+    x = np.zeros((m, n))
+    x[:,0] = rng.normal(size=m) / np.sqrt(1 - phi**2)
+    e = rng.normal(size=(m, n))
+    for i in range(1, n):
+        x[:,i] = phi*x[:,i-1] + e[:,i]
+    return x
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()